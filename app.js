@@ -45,6 +45,7 @@ const ui = {
   asrResultSection: document.getElementById("asrResultSection"),
   asrAudioPlayer: document.getElementById("asrAudioPlayer"),
   asrVideoPlayer: document.getElementById("asrVideoPlayer"),
+  loadAsrVideo: document.getElementById("loadAsrVideo"),
   asrKeywords: document.getElementById("asrKeywords"),
   asrSummary: document.getElementById("asrSummary"),
   asrTopics: document.getElementById("asrTopics"),
@@ -740,6 +741,7 @@ async function startAsr() {
         });
         
         // Use persistent audio URL from server for current session
+        ui.loadAsrVideo.style.display = "none";
         if (file.type.startsWith("video") || file.name.endsWith(".mkv")) {
             ui.asrVideoPlayer.src = data.audio_url;
             ui.asrVideoPlayer.style.display = "block";
@@ -823,7 +825,8 @@ async function startAsrUrl() {
         const res = await fetch("/api/asr-url", {
             method: "POST",
             headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({ url, dashscopeKey })
+            // 转写只需要音轨；完整视频在需要画面时再通过 /api/asr/<task_id>/video 获取
+            body: JSON.stringify({ url, dashscopeKey, media: "audio" })
         });
 
         const data = await res.json();
@@ -969,6 +972,10 @@ async function startAsrUrl() {
             ui.asrAudioPlayer.style.display = "block";
             ui.asrVideoPlayer.style.display = "none";
         }
+        // 只下载了音频时，可按需加载视频画面
+        ui.loadAsrVideo.dataset.taskId = data.task_id;
+        ui.loadAsrVideo.textContent = "加载视频画面";
+        ui.loadAsrVideo.style.display = fileType === 'video' ? "none" : "inline-block";
 
         ui.asrStatus.textContent = "转写完成！";
 
@@ -1035,6 +1042,37 @@ function updateAsrHighlight(time) {
     }
 }
 
+ui.loadAsrVideo.addEventListener("click", async () => {
+    const taskId = ui.loadAsrVideo.dataset.taskId;
+    if (!taskId) return;
+    ui.loadAsrVideo.disabled = true;
+    ui.loadAsrVideo.textContent = "正在下载视频...";
+    try {
+        const res = await fetch(`/api/asr/${taskId}/video`, { method: "POST" });
+        const data = await res.json();
+        if (!data.ok) throw new Error(data.error || "视频下载失败");
+        ui.loadAsrVideo.style.display = "none";
+        if (data.file_type !== 'video') {
+            ui.asrStatus.textContent = "该链接没有视频画面。";
+            return;
+        }
+        // 从音频当前的播放位置继续
+        const position = ui.asrAudioPlayer.currentTime;
+        ui.asrAudioPlayer.pause();
+        ui.asrVideoPlayer.addEventListener("loadedmetadata", () => {
+            ui.asrVideoPlayer.currentTime = position;
+        }, { once: true });
+        ui.asrVideoPlayer.src = data.video_url;
+        ui.asrVideoPlayer.style.display = "block";
+        ui.asrAudioPlayer.style.display = "none";
+    } catch (e) {
+        ui.asrStatus.textContent = "错误: " + e.message;
+        ui.loadAsrVideo.textContent = "加载视频画面";
+    } finally {
+        ui.loadAsrVideo.disabled = false;
+    }
+});
+
 [ui.asrAudioPlayer, ui.asrVideoPlayer].forEach(p => {
     p.addEventListener("timeupdate", () => {
         if (p.style.display !== "none") updateAsrHighlight(p.currentTime);
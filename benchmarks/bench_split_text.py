@@ -0,0 +1,99 @@
+"""
+Benchmark for split_text_for_say on 500k-character texts.
+
+Compares the current single-pass segmenter in server.py with the previous
+window-reversing implementation and checks that both produce identical output.
+
+Usage: python benchmarks/bench_split_text.py [--repeat N]
+"""
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import split_text_for_say, MAX_SAY_SEGMENT_LENGTH, MAX_TTS_TEXT_LENGTH
+
+
+def split_text_for_say_legacy(text, max_len):
+    # Previous implementation: reverse each window and regex-search it
+    t = str(text)
+    out = []
+    i = 0
+    while i < len(t):
+        j = min(i + max_len, len(t))
+        if j < len(t):
+            window = t[i:j]
+            match = re.search(r'(?:\n+|[。！？!?]\s*)', window[::-1])
+            if match:
+                offset = match.start()
+                if offset < max_len * 0.5:
+                    j = j - offset
+
+        out.append(t[i:j].strip())
+        i = j
+    return [c for c in out if c]
+
+
+def make_chinese_text(length, rng):
+    words = ["我们", "今天", "学习", "课文", "老师", "同学", "认真", "阅读", "思考", "问题", "上海", "中考", "作文"]
+    enders = ["，", "，", "。", "！", "？", "\n"]
+    parts = []
+    size = 0
+    while size < length:
+        sentence = "".join(rng.choice(words) for _ in range(rng.randint(3, 60))) + rng.choice(enders)
+        parts.append(sentence)
+        size += len(sentence)
+    return "".join(parts)[:length]
+
+
+def make_english_text(length, rng):
+    words = ["the", "lesson", "teacher", "student", "reads", "quietly", "about", "history", "and", "science"]
+    enders = [", ", ". ", "! ", "? ", "\n", "\n\n"]
+    parts = []
+    size = 0
+    while size < length:
+        sentence = " ".join(rng.choice(words) for _ in range(rng.randint(3, 120))) + rng.choice(enders)
+        parts.append(sentence)
+        size += len(sentence)
+    return "".join(parts)[:length]
+
+
+def bench(fn, text, repeat):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(text, MAX_SAY_SEGMENT_LENGTH)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    corpora = {
+        "chinese": make_chinese_text(MAX_TTS_TEXT_LENGTH, rng),
+        "english": make_english_text(MAX_TTS_TEXT_LENGTH, rng),
+        "no_boundaries": "字" * MAX_TTS_TEXT_LENGTH,
+    }
+
+    print(f"{'corpus':<15}{'chars':>10}{'segments':>10}{'legacy ms':>12}{'current ms':>12}{'speedup':>10}")
+    for name, text in corpora.items():
+        legacy_t, legacy_out = bench(split_text_for_say_legacy, text, args.repeat)
+        current_t, current_out = bench(split_text_for_say, text, args.repeat)
+        if legacy_out != current_out:
+            print(f"{name}: OUTPUT MISMATCH", file=sys.stderr)
+            sys.exit(1)
+        print(f"{name:<15}{len(text):>10}{len(current_out):>10}"
+              f"{legacy_t * 1000:>12.1f}{current_t * 1000:>12.1f}{legacy_t / current_t:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -87,11 +87,11 @@ const LogParser = {
                     continue;
                 }
                 
-                // 匹配 "Processing chunk X/Y..."
+                // 匹配 "Completed chunk X/Y"（分片并行转写，X为已完成数）及旧格式 "Processing chunk X/Y..."
                 // 只记录第一个找到的chunk（从最新日志往回找的第一个chunk）
-                // 这样能显示当前正在处理的chunk
+                // 这样能显示当前的分片进度
                 if (currentChunkNumber === 0) { // 还没有找到chunk
-                    const chunkMatch = line.match(/Processing chunk (\d+)\/(\d+)/);
+                    const chunkMatch = line.match(/(?:Completed|Processing) chunk (\d+)\/(\d+)/);
                     if (chunkMatch) {
                         const currentChunk = parseInt(chunkMatch[1]);
                         const thisTotalChunks = parseInt(chunkMatch[2]);
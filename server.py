@@ -1,18 +1,31 @@
 import os
 import sys
 import json
+import csv
 import re
 import time
 import uuid
+import hashlib
+import struct
+import sqlite3
 import shutil
 import tempfile
 import subprocess
 import unicodedata
+import bisect
 import asyncio
+import threading
+import functools
+import errno
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 import requests # Added for downloading TTS audio
 from http import HTTPStatus
+try:
+    import fcntl # Advisory locks on partial downloads (POSIX only)
+except ImportError:
+    fcntl = None
 from bs4 import BeautifulSoup
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context
 from datetime import datetime
 import yt_dlp
 
@@ -167,6 +180,155 @@ def get_output_dir():
     os.makedirs(local_out, exist_ok=True)
     return local_out
 
+# --- Helper: Disk Cache ---
+def link_or_copy(src, dst):
+    """Hardlink src to dst when both live on the same filesystem, copy otherwise."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+class DiskLRUCache:
+    """
+    Size-bounded on-disk cache. Every entry is a `<key>.json` metadata file plus
+    optional payload files `<key><ext>`. Recency is the mtime of the metadata
+    file, which is touched on every hit, so eviction drops least recently used.
+    With ttl (seconds), entries older than that are treated as missing and
+    dropped on the next get() or eviction.
+    """
+    def __init__(self, cache_dir, max_bytes, ttl=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._approx_bytes = self._scan()[1]
+
+    def path(self, key, ext):
+        return os.path.join(self.cache_dir, f"{key}{ext}")
+
+    def get(self, key):
+        """Return the entry metadata (payload paths under 'paths') or None."""
+        return self.get_any([key])[1]
+
+    def get_any(self, keys):
+        """
+        First of keys with an entry, as (key, metadata), or (None, None).
+        Counts as a single hit or miss however many keys are tried.
+        """
+        for key in keys:
+            meta = self._load(key)
+            if meta is not None:
+                with self._lock: self.hits += 1
+                return key, meta
+        with self._lock: self.misses += 1
+        return None, None
+
+    def _load(self, key):
+        meta_path = self.path(key, ".json")
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            paths = {ext: self.path(key, ext) for ext in meta.get("files", [])}
+            if not all(os.path.exists(p) for p in paths.values()):
+                raise FileNotFoundError(meta_path)
+            if self.ttl and time.time() - meta.get("created_at", 0) > self.ttl:
+                self._remove([meta_path] + list(paths.values()))
+                raise FileNotFoundError(meta_path)
+            os.utime(meta_path, None)
+        except (OSError, ValueError):
+            return None
+        meta["paths"] = paths
+        return meta
+
+    def put(self, key, meta, files=None):
+        """Store metadata and payload files ({ext: src_path}) under key."""
+        files = files or {}
+        added = 0
+        try:
+            for ext, src in files.items():
+                tmp = self.path(key, f"{ext}.{uuid.uuid4().hex}.tmp")
+                link_or_copy(src, tmp)
+                added += os.path.getsize(tmp)
+                os.replace(tmp, self.path(key, ext))
+            meta = dict(meta, files=list(files), created_at=time.time())
+            tmp = self.path(key, f".json.{uuid.uuid4().hex}.tmp")
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+            added += os.path.getsize(tmp)
+            os.replace(tmp, self.path(key, ".json"))
+        except OSError as e:
+            print(f"Cache write failed ({key}): {e}", file=sys.stderr)
+            return False
+        with self._lock:
+            self._approx_bytes += added
+            over = self._approx_bytes > self.max_bytes
+        if over: self.evict()
+        return True
+
+    def _scan(self):
+        """Group cache files by key. Returns ({key: (mtime, size, [paths])}, total_bytes)."""
+        entries = {}
+        total = 0
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return entries, 0
+        for name in names:
+            p = os.path.join(self.cache_dir, name)
+            try: st = os.stat(p)
+            except OSError: continue
+            key = name.split('.', 1)[0]
+            mtime, size, paths = entries.get(key, (0, 0, []))
+            if name == f"{key}.json": mtime = st.st_mtime
+            paths.append(p)
+            entries[key] = (mtime, size + st.st_size, paths)
+            total += st.st_size
+        return entries, total
+
+    def _remove(self, paths):
+        for p in paths:
+            try: os.remove(p)
+            except OSError: pass
+
+    def evict(self):
+        """Remove expired entries, then least recently used ones until the cache fits in max_bytes."""
+        with self._lock:
+            entries, total = self._scan()
+            # Recency only moves forward on hits, so an entry untouched for ttl is also expired
+            expired_before = time.time() - self.ttl if self.ttl else 0
+            for key, (mtime, size, paths) in sorted(entries.items(), key=lambda kv: kv[1][0]):
+                if total <= self.max_bytes and mtime >= expired_before: break
+                self._remove(paths)
+                total -= size
+            self._approx_bytes = total
+
+    def stats(self):
+        entries, total = self._scan()
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(entries),
+                "bytes": total,
+                "max_bytes": self.max_bytes
+            }
+
+_tts_cache = None
+
+def get_tts_cache():
+    """Shared cache of synthesized segments under tts_output/tts_cache, or None if disabled."""
+    global _tts_cache
+    if _tts_cache is None and TTS_CACHE_MAX_MB > 0:
+        _tts_cache = DiskLRUCache(os.path.join(get_output_dir(), "tts_cache"), TTS_CACHE_MAX_MB * 1024 * 1024)
+    return _tts_cache
+
+def tts_cache_key(model, voice, text):
+    raw = "\0".join([model, voice or "", normalize_text_for_tts(text)])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
 # --- Helper: History Storage ---
 def get_history_file():
     # Use a JSON file to persist history on server
@@ -220,10 +382,401 @@ MODEL_OCR = "qwen-vl-ocr-2025-11-20"
 
 MAX_TTS_TEXT_LENGTH = 500_000
 MAX_SAY_SEGMENT_LENGTH = 450 # Reduced from 1500 to 450 to meet [1, 512] API limit
+# Max number of TTS segments synthesized in parallel for long texts
+TTS_MAX_CONCURRENCY = int(os.environ.get("TTS_MAX_CONCURRENCY", 4))
+# Size cap for the synthesized-audio cache under tts_output/tts_cache (0 disables it)
+TTS_CACHE_MAX_MB = int(os.environ.get("TTS_CACHE_MAX_MB", 1024))
+# Qwen-Audio has timeout issues on long files, so ASR input is split into chunks of this many seconds
+ASR_CHUNK_DURATION = 300
+# Silence-aware chunk planning: chunk boundaries go into pauses, and silent spans
+# longer than ASR_SILENCE_DROP_MIN seconds are cut out before upload
+ASR_SILENCE_TRIM = os.environ.get("ASR_SILENCE_TRIM", "1") != "0"
+ASR_SILENCE_NOISE_DB = float(os.environ.get("ASR_SILENCE_NOISE_DB", -35))
+ASR_SILENCE_MIN_PAUSE = 0.5 # shortest pause usable as a chunk boundary (s)
+ASR_SILENCE_DROP_MIN = float(os.environ.get("ASR_SILENCE_DROP_MIN", 3.0))
+ASR_SILENCE_KEEP_PAD = 0.3 # silence kept on each side of a dropped span (s)
+# Size cap for cached ASR results under tts_output/asr_cache (0 disables it)
+ASR_CACHE_MAX_MB = int(os.environ.get("ASR_CACHE_MAX_MB", 256))
+# Max number of ASR chunks transcribed in parallel for long audio
+ASR_MAX_CONCURRENCY = int(os.environ.get("ASR_MAX_CONCURRENCY", 4))
+# Transcripts longer than this are analyzed in parts that are merged afterwards (map-reduce)
+LLM_ANALYSIS_CHUNK_CHARS = 15000
+LLM_ANALYSIS_CONCURRENCY = int(os.environ.get("LLM_ANALYSIS_CONCURRENCY", 4))
+# Threads per worker for LLM analysis requested with analysis=background
+ASR_ANALYSIS_WORKERS = int(os.environ.get("ASR_ANALYSIS_WORKERS", 2))
+# Unfinished ASR jobs (chunk checkpoints + source audio) are kept this long for /api/asr/<task_id>/resume
+ASR_JOB_TTL_HOURS = float(os.environ.get("ASR_JOB_TTL_HOURS", 72))
+# Segment WAVs kept for incremental TTS (base_id) are removed after this many hours
+TTS_PARTS_TTL_HOURS = float(os.environ.get("TTS_PARTS_TTL_HOURS", 24))
+# /api/asr/<task_id>/stream polling: interval, how long to wait for an unknown task to appear, overall limit (s)
+ASR_STREAM_POLL_INTERVAL = 0.5
+ASR_STREAM_JOB_WAIT = 60
+ASR_STREAM_MAX_DURATION = 3 * 3600
+# Downloads and ASR results of /api/asr-url, keyed by (extractor, video id) under tts_output/url_cache
+URL_CACHE_MAX_MB = int(os.environ.get("URL_CACHE_MAX_MB", 2048))
+URL_CACHE_TTL_HOURS = float(os.environ.get("URL_CACHE_TTL_HOURS", 168))
+# /api/asr-url transcribes fixed-length chunks of the audio while it is still downloading
+ASR_URL_PIPELINE = os.environ.get("ASR_URL_PIPELINE", "1") != "0"
+# Streaming download settings for generated/remote media
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = (10, 60) # (connect, read) seconds
+DOWNLOAD_TAIL_POLL = 0.2 # how often a reader of a growing download checks for new bytes (s)
+# Direct media links of at least DOWNLOAD_RANGE_MIN_SIZE bytes are fetched as parallel HTTP Range
+# parts into a preallocated file; finished parts are recorded so an interrupted download resumes
+DOWNLOAD_RANGE_CONNECTIONS = int(os.environ.get("DOWNLOAD_RANGE_CONNECTIONS", 4))
+DOWNLOAD_RANGE_PART_SIZE = 8 * 1024 * 1024
+DOWNLOAD_RANGE_MIN_SIZE = 4 * 1024 * 1024
+DOWNLOAD_RANGE_RETRIES = 3
+# DashScope rate limits as "requests_per_second:burst", shared by all worker processes.
+# DASHSCOPE_RATE_LIMITS overrides single models, e.g. "qwen-tts=5:10,qwen3-max-2025-09-23=1:2"
+DASHSCOPE_RATE_DEFAULT = os.environ.get("DASHSCOPE_RATE_DEFAULT", "3:6")
+DASHSCOPE_RATE_LIMITS = os.environ.get("DASHSCOPE_RATE_LIMITS", "")
+DASHSCOPE_RATE_DB = os.environ.get("DASHSCOPE_RATE_DB") or os.path.join(tempfile.gettempdir(), "chifanzuiyaojin_ratelimit.sqlite3")
+# Circuit breaker for the model fallback lists (state lives in DASHSCOPE_RATE_DB as well):
+# a model is skipped after MODEL_BREAKER_THRESHOLD consecutive failures for a cooldown that
+# doubles on every further failure; quota/unsupported errors open it at the maximum right away
+MODEL_BREAKER_THRESHOLD = int(os.environ.get("MODEL_BREAKER_THRESHOLD", 3))
+MODEL_BREAKER_COOLDOWN = float(os.environ.get("MODEL_BREAKER_COOLDOWN", 60))
+MODEL_BREAKER_MAX_COOLDOWN = float(os.environ.get("MODEL_BREAKER_MAX_COOLDOWN", 900))
+MODEL_BREAKER_PROBE_LEASE = 30 # seconds one worker has to probe a cooled-down model before others may
 
 # Initialize OCR (Removed local engine)
 # ocr_engine = RapidOCR()
 
+# --- Helper: Rate Limiting ---
+def parse_rate_spec(spec):
+    """'rate:burst' -> (rate, burst) floats. A rate of 0 or less means unlimited and gives (0.0, 0.0)."""
+    rate, _, burst = str(spec).partition(':')
+    rate = float(rate)
+    if rate <= 0: return 0.0, 0.0
+    # A bucket smaller than one token would never allow a request
+    return rate, max(1.0, float(burst)) if burst else max(1.0, rate)
+
+class TokenBucketRateLimiter:
+    """
+    Per-model token buckets kept in SQLite, so every gunicorn worker on the host
+    draws from the same DashScope quota. acquire() blocks until the model's bucket
+    has a token; penalize() empties the bucket and pauses it (backoff after a 429
+    or a transient error) for all workers.
+    """
+    def __init__(self, db_path, limits, default):
+        self.db_path = db_path
+        self.limits = limits
+        self.default = default
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets ("
+                         "model TEXT PRIMARY KEY, tokens REAL, updated REAL, blocked_until REAL)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _update(self, model, fn):
+        """Run fn(tokens, blocked_until, now, rate) -> (tokens, blocked_until, result) atomically."""
+        rate, burst = self.limits.get(model, self.default)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated, blocked_until FROM buckets WHERE model = ?", (model,)).fetchone()
+            tokens, updated, blocked_until = row if row else (burst, now, 0.0)
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            tokens, blocked_until, result = fn(tokens, blocked_until, now, rate)
+            conn.execute("INSERT OR REPLACE INTO buckets (model, tokens, updated, blocked_until) VALUES (?, ?, ?, ?)",
+                         (model, tokens, now, blocked_until))
+            conn.execute("COMMIT")
+            return result
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def acquire(self, model):
+        """Block until a request to model is allowed."""
+        def take(tokens, blocked_until, now, rate):
+            if blocked_until > now: return tokens, blocked_until, blocked_until - now
+            if rate <= 0: return tokens, blocked_until, 0 # Unlimited; only penalize() pauses it
+            if tokens >= 1: return tokens - 1, blocked_until, 0
+            return tokens, blocked_until, (1 - tokens) / rate
+        while True:
+            try:
+                wait = self._update(model, take)
+            except sqlite3.Error as e:
+                print(f"Rate limiter unavailable ({e}), not throttling {model}", file=sys.stderr)
+                return
+            if wait <= 0: return
+            time.sleep(min(wait, 1.0))
+
+    def penalize(self, model, seconds):
+        """Pause model's bucket for at least `seconds`."""
+        print(f"Rate limit: pausing {model} for {seconds:.1f}s", file=sys.stderr)
+        try:
+            self._update(model, lambda tokens, blocked_until, now, rate: (0.0, max(blocked_until, now + seconds), None))
+        except sqlite3.Error as e:
+            print(f"Rate limiter unavailable ({e})", file=sys.stderr)
+
+class NullRateLimiter:
+    """Stand-in when the shared rate-limit database cannot be opened: never throttles."""
+    def acquire(self, model):
+        pass
+
+    def penalize(self, model, seconds):
+        pass
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+def get_rate_limiter():
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            limits = {}
+            for item in filter(None, DASHSCOPE_RATE_LIMITS.split(',')):
+                model, _, spec = item.partition('=')
+                limits[model.strip()] = parse_rate_spec(spec)
+            try:
+                _rate_limiter = TokenBucketRateLimiter(DASHSCOPE_RATE_DB, limits, parse_rate_spec(DASHSCOPE_RATE_DEFAULT))
+            except sqlite3.Error as e:
+                print(f"Rate limiter unavailable ({DASHSCOPE_RATE_DB}: {e}), not throttling DashScope calls", file=sys.stderr)
+                _rate_limiter = NullRateLimiter()
+        return _rate_limiter
+
+def is_rate_limited(status_code, message):
+    """True for DashScope/HTTP throttling responses (429 or Throttling error codes)."""
+    return status_code == 429 or "throttl" in str(message).lower() or "rate limit" in str(message).lower()
+
+def retry_after_seconds(obj, default):
+    """
+    Retry-After header (seconds) of a requests response, else default.
+    DashScope SDK responses carry no headers, so their throttling uses backoff.
+    """
+    headers = getattr(obj, "headers", None) or {}
+    try:
+        return max(float(headers.get("Retry-After")), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+def call_dashscope(model, call, max_retries=3):
+    """
+    Acquire a token for model and return call()'s DashScope response. A
+    throttled response or exception (see is_rate_limited) penalizes the
+    model's bucket for every worker and is retried with exponential backoff;
+    after max_retries the last response is returned (or the exception raised).
+    """
+    for attempt in range(max_retries):
+        get_rate_limiter().acquire(model)
+        try:
+            resp = call()
+        except Exception as e:
+            if not is_rate_limited(None, e): raise
+            get_rate_limiter().penalize(model, 2 ** attempt)
+            if attempt == max_retries - 1: raise
+            print(f"{model} throttled ({e}), retrying...", file=sys.stderr)
+            continue
+        if resp.status_code == HTTPStatus.OK or not is_rate_limited(resp.status_code, f"{resp.code} {resp.message}"):
+            return resp
+        get_rate_limiter().penalize(model, 2 ** attempt)
+        print(f"{model} throttled ({resp.message}), retrying...", file=sys.stderr)
+    return resp
+
+# --- Helper: Model Health ---
+class ModelHealthTracker:
+    """
+    Circuit breaker per model, kept in SQLite next to the rate limiter so all
+    workers share it. A closed model is always tried; an open one is skipped
+    until its cooldown ends, after which a single caller gets to probe it
+    (holding a short lease) and either closes it again or reopens it with a
+    longer cooldown.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS model_health ("
+                         "model TEXT PRIMARY KEY, state TEXT, consecutive INTEGER, failures INTEGER, "
+                         "successes INTEGER, open_until REAL, last_error TEXT, last_failure REAL, last_success REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS model_latency ("
+                         "model TEXT PRIMARY KEY, samples INTEGER, ttft_avg REAL, tokens_per_s_avg REAL, "
+                         "last_ttft REAL, last_tokens_per_s REAL)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _update(self, model, fn):
+        """Run fn(row dict, now) -> result atomically; fn may modify the row."""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = conn.execute("SELECT state, consecutive, failures, successes, open_until, last_error, last_failure, last_success "
+                               "FROM model_health WHERE model = ?", (model,)).fetchone()
+            keys = ("state", "consecutive", "failures", "successes", "open_until", "last_error", "last_failure", "last_success")
+            h = dict(zip(keys, row)) if row else dict(zip(keys, ("closed", 0, 0, 0, 0.0, None, None, None)))
+            result = fn(h, now)
+            conn.execute("INSERT OR REPLACE INTO model_health VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (model,) + tuple(h[k] for k in keys))
+            conn.execute("COMMIT")
+            return result
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def try_acquire(self, model):
+        """True if model may be called now (closed, or open with an expired cooldown and no probe in flight)."""
+        def check(h, now):
+            if h["state"] == "closed": return True
+            if now < h["open_until"]: return False
+            h["open_until"] = now + MODEL_BREAKER_PROBE_LEASE
+            return True
+        try:
+            return self._update(model, check)
+        except sqlite3.Error as e:
+            print(f"Model health unavailable ({e})", file=sys.stderr)
+            return True
+
+    def candidates(self, models):
+        """
+        Yield the models worth trying, in list order. If every model is open,
+        the one whose cooldown ends first is still yielded so requests never
+        fail without at least one attempt.
+        """
+        skipped = []
+        for model in models:
+            if self.try_acquire(model):
+                yield model
+            else:
+                print(f"Model health: skipping {model} (circuit open)", file=sys.stderr)
+                skipped.append(model)
+        if len(skipped) == len(models) and models:
+            yield min(skipped, key=self._open_until)
+
+    def _open_until(self, model):
+        """When the model's cooldown ends (0 if unknown)."""
+        try:
+            row = self._connect().execute("SELECT open_until FROM model_health WHERE model = ?", (model,)).fetchone()
+        except sqlite3.Error:
+            return 0.0
+        return row[0] if row else 0.0
+
+    def record_success(self, model):
+        def ok(h, now):
+            h.update(state="closed", consecutive=0, open_until=0.0, successes=h["successes"] + 1, last_success=now)
+        try: self._update(model, ok)
+        except sqlite3.Error as e: print(f"Model health unavailable ({e})", file=sys.stderr)
+
+    def record_failure(self, model, error, fatal=False):
+        """Count a failed call; fatal errors (quota, unsupported model) open the circuit immediately."""
+        def fail(h, now):
+            h.update(consecutive=h["consecutive"] + 1, failures=h["failures"] + 1,
+                     last_error=str(error)[:500], last_failure=now)
+            if fatal or h["consecutive"] >= MODEL_BREAKER_THRESHOLD:
+                extra = max(0, h["consecutive"] - MODEL_BREAKER_THRESHOLD)
+                cooldown = MODEL_BREAKER_MAX_COOLDOWN if fatal else min(MODEL_BREAKER_MAX_COOLDOWN, MODEL_BREAKER_COOLDOWN * 2 ** extra)
+                h.update(state="open", open_until=now + cooldown)
+                return cooldown
+        try:
+            cooldown = self._update(model, fail)
+            if cooldown: print(f"Model health: {model} circuit open for {cooldown:.0f}s", file=sys.stderr)
+        except sqlite3.Error as e:
+            print(f"Model health unavailable ({e})", file=sys.stderr)
+
+    def record_latency(self, model, ttft=None, tokens_per_s=None):
+        """Add a streamed call's time to first token and output speed to the model's running averages."""
+        if ttft is None: return
+        try:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT samples, ttft_avg, tokens_per_s_avg FROM model_latency WHERE model = ?", (model,)).fetchone()
+                samples, ttft_avg, tps_avg = row if row else (0, 0.0, None)
+                ttft_avg = (ttft_avg * samples + ttft) / (samples + 1)
+                if tokens_per_s is not None:
+                    tps_avg = tokens_per_s if tps_avg is None else (tps_avg * samples + tokens_per_s) / (samples + 1)
+                conn.execute("INSERT OR REPLACE INTO model_latency VALUES (?, ?, ?, ?, ?, ?)",
+                             (model, samples + 1, ttft_avg, tps_avg, ttft, tokens_per_s))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            print(f"Model health unavailable ({e})", file=sys.stderr)
+
+    def snapshot(self):
+        """Current state and streaming latency of every tracked model."""
+        try:
+            conn = self._connect()
+            rows = conn.execute("SELECT model, state, consecutive, failures, successes, open_until, "
+                                "last_error, last_failure, last_success FROM model_health ORDER BY model").fetchall()
+            latency = {r[0]: r[1:] for r in conn.execute("SELECT model, samples, ttft_avg, tokens_per_s_avg, "
+                                                          "last_ttft, last_tokens_per_s FROM model_latency").fetchall()}
+        except sqlite3.Error:
+            return []
+        now = time.time()
+        out = []
+        for model, state, consecutive, failures, successes, open_until, last_error, last_failure, last_success in rows:
+            if state == "open" and now >= open_until: state = "half_open"
+            entry = {
+                "model": model, "state": state, "consecutive_failures": consecutive,
+                "failures": failures, "successes": successes,
+                "retry_in": round(max(0.0, open_until - now), 1) if state == "open" else 0,
+                "last_error": last_error, "last_failure": last_failure, "last_success": last_success
+            }
+            if model in latency:
+                samples, ttft_avg, tps_avg, last_ttft, last_tps = latency[model]
+                entry["latency"] = {
+                    "samples": samples,
+                    "ttft_avg": round(ttft_avg, 3),
+                    "tokens_per_s_avg": round(tps_avg, 1) if tps_avg is not None else None,
+                    "last_ttft": last_ttft,
+                    "last_tokens_per_s": last_tps
+                }
+            out.append(entry)
+        return out
+
+class NullModelHealth:
+    """Stand-in when the shared health database cannot be opened: every model is healthy, nothing is recorded."""
+    def candidates(self, models):
+        return iter(models)
+
+    def record_success(self, model):
+        pass
+
+    def record_failure(self, model, error, fatal=False):
+        pass
+
+    def record_latency(self, model, ttft=None, tokens_per_s=None):
+        pass
+
+    def snapshot(self):
+        return []
+
+_model_health = None
+_model_health_lock = threading.Lock()
+
+def get_model_health():
+    global _model_health
+    with _model_health_lock:
+        if _model_health is None:
+            try:
+                _model_health = ModelHealthTracker(DASHSCOPE_RATE_DB)
+            except sqlite3.Error as e:
+                print(f"Model health unavailable ({DASHSCOPE_RATE_DB}: {e}), trying every model", file=sys.stderr)
+                _model_health = NullModelHealth()
+        return _model_health
+
+def is_model_unavailable(message):
+    """Errors that will not go away by retrying the same model soon (quota, billing, unsupported model/input)."""
+    msg = str(message).lower()
+    return any(k in msg for k in ("free tier", "freetieronly", "quota", "arrearage", "payment",
+                                  "does not support", "model not exist", "modelnotfound", "access denied", "accessdenied"))
+
 # --- Helper: FFmpeg ---
 def ensure_ffmpeg_in_path():
     common_paths = ["/opt/homebrew/bin", "/usr/local/bin", "/usr/bin", "/bin"]
@@ -236,6 +789,251 @@ def ensure_ffmpeg_in_path():
 
 ensure_ffmpeg_in_path()
 
+# --- Helper: HTTP Download ---
+class IncompleteDownloadError(requests.exceptions.RequestException):
+    """Body length did not match Content-Length."""
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """Process-wide requests.Session so downloads reuse pooled TCP/TLS connections."""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            pool_size = max(10, TTS_MAX_CONCURRENCY * 2)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _http_session = session
+        return _http_session
+
+def download_to_file(url, output_path, headers=None, timeout=DOWNLOAD_TIMEOUT, chunk_size=DOWNLOAD_CHUNK_SIZE, progress=None):
+    """
+    Stream url to output_path in chunk_size pieces without buffering the body.
+    Writes to '<output_path>.part' and renames on success, so a failed download
+    never leaves a truncated file behind. progress(path, bytes) is called after
+    every piece with the file being written. Returns the number of bytes written.
+    """
+    tmp_path = f"{output_path}.part"
+    written = 0
+    try:
+        with get_http_session().get(url, headers=headers, stream=True, timeout=timeout) as r:
+            r.raise_for_status()
+            expected = r.headers.get("Content-Length")
+            # With Content-Encoding the decoded body legitimately differs in length
+            if r.headers.get("Content-Encoding", "identity") != "identity": expected = None
+            with open(tmp_path, "wb") as f:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    if chunk:
+                        f.write(chunk)
+                        written += len(chunk)
+                        if progress:
+                            f.flush()
+                            progress(tmp_path, written)
+        if expected is not None and written != int(expected):
+            raise IncompleteDownloadError(f"Incomplete download: got {written} of {expected} bytes from {url}")
+        os.replace(tmp_path, output_path)
+        return written
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+
+def probe_range_support(url, headers=None, timeout=DOWNLOAD_TIMEOUT):
+    """
+    Request the first byte of url. Returns (size, validators) if the server
+    answers with a 206 and the full length in Content-Range, else (None, None);
+    validators are the ETag and Last-Modified headers.
+    """
+    probe_headers = dict(headers or {}, **{"Range": "bytes=0-0", "Accept-Encoding": "identity"})
+    with get_http_session().get(url, headers=probe_headers, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        m = re.match(r'bytes 0-0/(\d+)$', r.headers.get("Content-Range", ""))
+        if r.status_code != 206 or not m: return None, None
+        return int(m.group(1)), {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+
+def lock_file_nonblocking(f):
+    """Exclusive advisory lock on an open file; True if acquired (always, where flock is unavailable)."""
+    if fcntl is None: return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+def partial_downloads_dir(output_dir):
+    """Where download_ranged keeps interrupted downloads of files saved to output_dir, with their state."""
+    return os.path.join(output_dir, "downloads")
+
+def download_ranged(url, output_path, headers=None, timeout=DOWNLOAD_TIMEOUT, progress=None,
+                    connections=DOWNLOAD_RANGE_CONNECTIONS, part_size=DOWNLOAD_RANGE_PART_SIZE):
+    """
+    Download url to output_path with parallel HTTP Range requests. The file
+    is preallocated as 'dl-<url hash>.part' in the downloads directory next
+    to output_path (see partial_downloads_dir) and
+    `connections` threads fetch part_size pieces into it, each writing
+    through its own handle at its offset in DOWNLOAD_CHUNK_SIZE buffers.
+    Finished parts are recorded in '<partial>.json', so calling this again
+    for the same URL after an interruption only fetches the missing parts;
+    the record is discarded if the size, ETag or Last-Modified changed.
+    Servers without range support (or failing the probe), small files and a
+    partial file locked by another download of the URL use download_to_file
+    instead.
+    progress(path, bytes) gets the length of the prefix of path that is final.
+    Returns the number of bytes downloaded.
+    """
+    try:
+        size, validators = probe_range_support(url, headers, timeout)
+    except requests.exceptions.RequestException as e:
+        print(f"Range probe of {url} failed ({e}), downloading with one connection", file=sys.stderr)
+        size = None
+    if not size or size < DOWNLOAD_RANGE_MIN_SIZE or connections <= 1:
+        return download_to_file(url, output_path, headers=headers, timeout=timeout, progress=progress)
+    
+    partial_dir = partial_downloads_dir(os.path.dirname(output_path))
+    os.makedirs(partial_dir, exist_ok=True)
+    partial = os.path.join(partial_dir, f"dl-{hashlib.sha256(url.encode('utf-8')).hexdigest()[:24]}.part")
+    state_path = f"{partial}.json"
+    with open(partial, "a+b") as handle:
+        if not lock_file_nonblocking(handle):
+            print(f"Ranged download of {url} already in progress, downloading separately", file=sys.stderr)
+            return download_to_file(url, output_path, headers=headers, timeout=timeout, progress=progress)
+        
+        record = {"url": url, "size": size, "part_size": part_size, **validators}
+        try:
+            with open(state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        resumable = all(state.get(k) == v for k, v in record.items()) and os.path.getsize(partial) == size
+        done = set(state.get("done", [])) if resumable else set()
+        if not resumable:
+            handle.truncate(size)
+            if hasattr(os, "posix_fallocate"):
+                try: os.posix_fallocate(handle.fileno(), 0, size)
+                except OSError as e:
+                    if e.errno == errno.ENOSPC: raise
+        write_json_atomic(state_path, dict(record, done=sorted(done)))
+        
+        n_parts = (size + part_size - 1) // part_size
+        part_len = lambda i: min(size, (i + 1) * part_size) - i * part_size
+        written = [part_len(i) if i in done else 0 for i in range(n_parts)]
+        lock = threading.Lock()
+        failed = threading.Event()
+        if done:
+            print(f"Resuming ranged download of {url}: {len(done)}/{n_parts} parts already done", file=sys.stderr)
+        
+        def report():
+            if not progress: return
+            with lock:
+                prefix = 0
+                for i in range(n_parts):
+                    prefix += written[i]
+                    if written[i] < part_len(i): break
+            progress(partial, prefix)
+        
+        def fetch_part(i):
+            start, end = i * part_size, i * part_size + part_len(i) - 1
+            range_headers = dict(headers or {}, **{"Range": f"bytes={start}-{end}", "Accept-Encoding": "identity"})
+            # If the file changed since the probe, the server answers 200 with the new file instead
+            if validators["etag"] or validators["last_modified"]:
+                range_headers["If-Range"] = validators["etag"] or validators["last_modified"]
+            for attempt in range(DOWNLOAD_RANGE_RETRIES):
+                try:
+                    with open(partial, "r+b") as f, get_http_session().get(url, headers=range_headers, stream=True, timeout=timeout) as r:
+                        r.raise_for_status()
+                        if r.status_code != 206:
+                            raise IncompleteDownloadError(f"Range request for part {i} of {url} answered with {r.status_code}")
+                        f.seek(start)
+                        with lock: written[i] = 0
+                        for buf in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            if failed.is_set(): return
+                            f.write(buf)
+                            with lock: written[i] += len(buf)
+                            if progress:
+                                f.flush()
+                                report()
+                    if written[i] != part_len(i):
+                        raise IncompleteDownloadError(f"Incomplete part {i}: got {written[i]} of {part_len(i)} bytes from {url}")
+                    with lock:
+                        done.add(i)
+                        write_json_atomic(state_path, dict(record, done=sorted(done)))
+                    report()
+                    return
+                except requests.exceptions.RequestException as e:
+                    if failed.is_set() or attempt == DOWNLOAD_RANGE_RETRIES - 1:
+                        failed.set()
+                        raise
+                    print(f"Part {i} of {url} failed ({e}), retrying", file=sys.stderr)
+                    time.sleep(2 ** attempt)
+        
+        todo = [i for i in range(n_parts) if i not in done]
+        if todo:
+            with ThreadPoolExecutor(max_workers=min(connections, len(todo))) as pool:
+                futures = [pool.submit(fetch_part, i) for i in todo]
+                for fut in futures:
+                    try: fut.result()
+                    except Exception:
+                        failed.set()
+                        raise
+        os.replace(partial, output_path)
+    os.remove(state_path)
+    return size
+
+class DownloadTail:
+    """
+    Read side of a download in progress. The downloader reports the file it
+    writes and how many bytes from its start are final; chunks() yields them
+    as they arrive, so ffmpeg can decode the media before it is complete.
+    The file is opened by the first update(), in the downloader's thread, and
+    read through that one handle, so renaming it on completion (.part -> final
+    name) does not disturb the reader, even if that happens before it starts.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.path = None
+        self._file = None
+        self.available = 0
+        self.done = False
+
+    def update(self, path, available):
+        with self._cond:
+            if self.path is None:
+                self._file = open(path, 'rb')
+                self.path = path
+            self.available = max(self.available, available)
+            self._cond.notify_all()
+
+    def finish(self):
+        """Called once the download returned, successfully or not."""
+        with self._cond:
+            self.done = True
+            self._cond.notify_all()
+
+    def wait_started(self):
+        """Block until the downloader reported its file; False if it finished without one (cache hit, error)."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.path or self.done)
+            return self.path is not None
+
+    def chunks(self, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        if not self.wait_started(): return
+        pos = 0
+        with self._file as f:
+            while True:
+                with self._cond:
+                    done, available = self.done, self.available
+                # Once done everything up to EOF is final, before that only the reported prefix
+                size = chunk_size if done else min(chunk_size, available - pos)
+                buf = f.read(size) if size > 0 else b''
+                if buf:
+                    pos += len(buf)
+                    yield buf
+                    continue
+                if done: return
+                with self._cond:
+                    if not self.done: self._cond.wait(DOWNLOAD_TAIL_POLL)
+
 # --- Helper: URL Download ---
 def extract_url_from_text(text):
     """
@@ -252,13 +1050,73 @@ def extract_url_from_text(text):
         return 'https://' + b23_match.group(0)
     return text
 
-def download_audio_video_from_url(url, output_dir):
+YTDLP_BASE_OPTS = {
+    'noplaylist': True,
+    'quiet': True,
+    'no_warnings': True,
+    'ignoreerrors': False,
+    'nocheckcertificate': True,
+    'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+}
+DIRECT_MEDIA_EXTENSIONS = ['.mp3', '.wav', '.m4a', '.ogg', '.flac', '.aac',
+                           '.mp4', '.mkv', '.avi', '.mov', '.webm', '.flv']
+
+def is_direct_media_url(url):
+    """Direct file URL (ends with a common media extension), downloaded without yt-dlp."""
+    return any(url.lower().endswith(ext) for ext in DIRECT_MEDIA_EXTENSIONS)
+
+def resolve_media_url(url):
+    """
+    Canonical identity of a media URL without downloading anything, so short
+    links (b23.tv), mobile and desktop URLs of one video share cache entries.
+    Returns (media_key, info): media_key is "<extractor>:<video id>" for video
+    sites or "direct:<url hash>" for direct file links; info is yt-dlp's
+    unprocessed result for download_audio_video_from_url (None for direct
+    links). Returns (None, None) if the URL cannot be resolved.
+    """
+    url = extract_url_from_text(url)
+    if is_direct_media_url(url):
+        return "direct:" + hashlib.sha256(url.encode('utf-8')).hexdigest()[:32], None
+    try:
+        with yt_dlp.YoutubeDL(YTDLP_BASE_OPTS) as ydl:
+            info = ydl.extract_info(url, download=False, process=False)
+            # Short links and embeds come back as url results pointing at the real page
+            for _ in range(3):
+                if not info or info.get("id") or info.get("_type") not in ("url", "url_transparent"): break
+                info = ydl.extract_info(info["url"], ie_key=info.get("ie_key"), download=False, process=False)
+    except Exception as e:
+        print(f"Could not resolve media URL {url}: {e}", file=sys.stderr)
+        return None, None
+    if not info or not info.get("id"): return None, info
+    extractor = info.get("extractor_key") or info.get("ie_key") or info.get("extractor")
+    return f"{extractor}:{info['id']}", info
+
+# yt-dlp format selectors: full video for playback, audio (or smallest format with audio) for ASR
+YTDLP_VIDEO_FORMAT = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/bestvideo+bestaudio/best'
+YTDLP_AUDIO_FORMAT = 'bestaudio[ext=m4a]/bestaudio/worst[acodec!=none]'
+
+def ytdlp_downloaded_path(ydl, info):
+    """Final file of a finished extract_info(download=True), as reported by yt-dlp (after merging)."""
+    if info.get("_type") == "playlist" and info.get("entries"):
+        info = next((e for e in info["entries"] if e), info)
+    for download in info.get("requested_downloads") or []:
+        if download.get("filepath"): return download["filepath"]
+    if info.get("filepath"): return info["filepath"]
+    return ydl.prepare_filename(info)
+
+def download_audio_video_from_url(url, output_dir, audio_only=False, info=None, tail=None):
     """
     Download audio/video from URL using yt-dlp or direct download.
     Supports:
     - Direct file URLs (mp3, wav, mp4, etc.)
     - Video websites (B站, YouTube, etc.) via yt-dlp
     - Text with Chinese title and URL (e.g., "【标题】https://b23.tv/xxx")
+    With audio_only, video sites only deliver the best audio stream (or, if
+    the site has none, the smallest format that still carries audio), which
+    is all ASR needs. info is an unprocessed yt-dlp result from
+    resolve_media_url, so the page is not extracted a second time. A
+    DownloadTail is told about every block written, so the file can be read
+    while it downloads.
     Returns: (success, downloaded_path, error, original_url)
     """
     original_url = url
@@ -271,39 +1129,23 @@ def download_audio_video_from_url(url, output_dir):
     
     print(f"Downloading from URL: {url}", file=sys.stderr)
     
-    # Check if this is a direct file URL (ends with common media extensions)
-    direct_file_extensions = ['.mp3', '.wav', '.m4a', '.ogg', '.flac', '.aac', 
-                            '.mp4', '.mkv', '.avi', '.mov', '.webm', '.flv']
-    is_direct_file = any(url.lower().endswith(ext) for ext in direct_file_extensions)
-    
-    if is_direct_file:
+    if is_direct_media_url(url):
         # Direct download using requests
         try:
             headers = {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
             }
             print("Using direct download...", file=sys.stderr)
-            response = requests.get(url, headers=headers, stream=True, timeout=60)
-            response.raise_for_status()
             
-            # Get file extension from URL or Content-Type
-            ext = os.path.splitext(url)[1] if '.' in url.split('/')[-1] else '.mp3'
-            if not ext:
-                content_type = response.headers.get('content-type', '')
-                if 'audio' in content_type:
-                    ext = '.mp3'
-                elif 'video' in content_type:
-                    ext = '.mp4'
-                else:
-                    ext = '.mp3'
+            # Direct links end with a media extension (is_direct_media_url)
+            ext = os.path.splitext(url)[1] or '.mp3'
             
             # Save file
             filename = f"asr-{uuid.uuid4()}{ext}"
             output_path = os.path.join(output_dir, filename)
             
-            with open(output_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
+            # Parallel ranges with resume where the server supports them, else one stream
+            download_ranged(url, output_path, headers=headers, progress=tail.update if tail else None)
             
             print(f"Direct download complete: {output_path}", file=sys.stderr)
             return True, output_path, None, url
@@ -320,14 +1162,11 @@ def download_audio_video_from_url(url, output_dir):
             
             # Configure yt-dlp options to download video (not extract audio)
             ydl_opts = {
-                # Explicitly download best video WITH audio (not just audio)
-                'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/bestvideo+bestaudio/best',
-                'outtmpl': os.path.join(output_dir, 'asr-%(id)s.%(ext)s'),
-                'quiet': True,
-                'no_warnings': True,
-                'ignoreerrors': False,
-                'nocheckcertificate': True,
-                'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+                **YTDLP_BASE_OPTS,
+                # Explicitly download best video WITH audio (not just audio), unless only audio is wanted
+                'format': YTDLP_AUDIO_FORMAT if audio_only else YTDLP_VIDEO_FORMAT,
+                # Unique name per request, so the result never has to be searched for
+                'outtmpl': os.path.join(output_dir, f'asr-{uuid.uuid4()}.%(ext)s'),
                 # Merge formats if video and audio are separate
                 'merge_output_format': 'mp4',
                 # Don't embed subtitles
@@ -336,41 +1175,26 @@ def download_audio_video_from_url(url, output_dir):
                 # CRITICAL: Don't extract audio to mp3, keep original format
                 'postprocessors': [],  # Empty list to prevent audio extraction
             }
+            if tail:
+                def report_progress(d):
+                    if d.get('status') == 'downloading' and d.get('tmpfilename'):
+                        tail.update(d['tmpfilename'], d.get('downloaded_bytes') or 0)
+                ydl_opts['progress_hooks'] = [report_progress]
             
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                # Extract info first
-                info = ydl.extract_info(url, download=False)
+                # Resolve and download in one call, or finish a resolve_media_url result
+                if info is not None:
+                    info = ydl.process_ie_result(info, download=True)
+                else:
+                    info = ydl.extract_info(url, download=True)
                 if not info:
                     return False, None, "无法解析此URL，请检查链接是否正确", original_url
-                
-                # Get video title for logging
-                video_title = info.get('title', 'Unknown')
-                print(f"Found video: {video_title}", file=sys.stderr)
-                
-                # Download
-                ydl.download([url])
+                output_path = ytdlp_downloaded_path(ydl, info)
             
-            # Find downloaded file (yt-dlp adds extension - support both video and audio formats)
-            # IMPORTANT: Support both 'asr-' prefix (for converted files) and video ID (for original yt-dlp downloads)
-            supported_extensions = ['.mp4', '.webm', '.mkv', '.mp3', '.wav', '.m4a']
+            # Get video title for logging
+            print(f"Found video: {info.get('title', 'Unknown')}", file=sys.stderr)
             
-            # First try to find files with 'asr-' prefix (from our download template)
-            downloaded_files = [f for f in os.listdir(output_dir) 
-                             if f.startswith('asr-') and any(f.endswith(ext) for ext in supported_extensions)]
-            
-            if not downloaded_files:
-                # If no 'asr-' files found, look for files with video ID or recent downloads
-                # Get video ID from info dict for filename matching
-                video_id = info.get('id', '')
-                if video_id:
-                    # Look for files starting with video ID
-                    downloaded_files = [f for f in os.listdir(output_dir) 
-                                     if f.startswith(video_id) and any(f.endswith(ext) for ext in supported_extensions)]
-            
-            if downloaded_files:
-                # Get most recent file
-                downloaded_files.sort(key=lambda x: os.path.getmtime(os.path.join(output_dir, x)), reverse=True)
-                output_path = os.path.join(output_dir, downloaded_files[0])
+            if output_path and os.path.exists(output_path):
                 print(f"yt-dlp download complete: {output_path}", file=sys.stderr)
                 return True, output_path, None, url
             else:
@@ -385,15 +1209,188 @@ def download_audio_video_from_url(url, output_dir):
             print(error_msg, file=sys.stderr)
             return False, None, error_msg, original_url
 
-def get_audio_duration(file_path):
-    if not shutil.which("ffprobe"): return 0
+_url_cache = None
+
+def get_url_cache():
+    """Media and ASR result pointers keyed by canonical video identity under tts_output/url_cache, or None if disabled."""
+    global _url_cache
+    if _url_cache is None and URL_CACHE_MAX_MB > 0:
+        _url_cache = DiskLRUCache(os.path.join(get_output_dir(), "url_cache"),
+                                  URL_CACHE_MAX_MB * 1024 * 1024, ttl=URL_CACHE_TTL_HOURS * 3600)
+    return _url_cache
+
+def url_cache_key(kind, media_key):
+    """kind is "audio"/"video" for downloaded media or "asr" for the ASR result pointer."""
+    return f"{kind}-{hashlib.sha256(media_key.encode('utf-8')).hexdigest()[:40]}"
+
+def fetch_url_media(url, output_dir, audio_only=False, tail=None):
+    """
+    download_audio_video_from_url behind the URL cache. A cached download is
+    hardlinked into output_dir under a fresh name instead of fetched again.
+    tail (a DownloadTail) follows the download and is finished on return;
+    it never sees a file if the result came from the cache.
+    Returns dict(ok, path, error, source_url, media_key, cached).
+    """
     try:
-        cmd = ["ffprobe", "-v", "error", "-show_entries", "format=duration", 
-               "-of", "default=noprint_wrappers=1:nokey=1", file_path]
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        return float(result.stdout.strip())
-    except:
-        return 0
+        return _fetch_url_media(url, output_dir, audio_only, tail)
+    finally:
+        if tail: tail.finish()
+
+def _fetch_url_media(url, output_dir, audio_only, tail):
+    media_key, info = resolve_media_url(url)
+    cache = get_url_cache() if media_key else None
+    key = url_cache_key("audio" if audio_only else "video", media_key) if cache else None
+    if cache:
+        entry = cache.get(key)
+        if entry and entry["paths"]:
+            ext, cached_path = next(iter(entry["paths"].items()))
+            path = os.path.join(output_dir, f"asr-{uuid.uuid4()}{ext}")
+            link_or_copy(cached_path, path)
+            print(f"URL cache hit: {media_key}", file=sys.stderr)
+            return {"ok": True, "path": path, "error": None, "source_url": entry.get("source_url") or url,
+                    "media_key": media_key, "cached": True}
+    
+    if cache: cache.evict()  # A miss is about to download anyway; drop expired entries first
+    success, path, error, original_url = download_audio_video_from_url(url, output_dir, audio_only, info=info, tail=tail)
+    if success and cache:
+        cache.put(key, {"media_key": media_key, "source_url": original_url}, {os.path.splitext(path)[1]: path})
+    return {"ok": success, "path": path, "error": error, "source_url": original_url,
+            "media_key": media_key, "cached": False}
+
+# --- Helper: WAV ---
+def read_wav_info(file_path):
+    """
+    Parse the RIFF/WAVE chunk headers of file_path without decoding audio.
+    Returns dict(fmt, channels, sample_rate, block_align, data_offset, data_size)
+    or None if the file is not a plain WAV.
+    """
+    try:
+        file_size = os.path.getsize(file_path)
+        with open(file_path, 'rb') as f:
+            header = f.read(12)
+            if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+                return None
+            fmt = None
+            while True:
+                chunk = f.read(8)
+                if len(chunk) < 8: return None
+                chunk_id, chunk_size = chunk[:4], struct.unpack('<I', chunk[4:])[0]
+                if chunk_id == b'fmt ':
+                    fmt = f.read(chunk_size)
+                    if chunk_size % 2: f.seek(1, 1)
+                elif chunk_id == b'data':
+                    if not fmt or len(fmt) < 16: return None
+                    _, channels, sample_rate, _, block_align = struct.unpack('<HHIIH', fmt[:14])
+                    if not sample_rate or not block_align: return None
+                    data_offset = f.tell()
+                    available = file_size - data_offset
+                    # Streaming writers leave the size as 0 or 0xFFFFFFFF
+                    if chunk_size == 0 or chunk_size > available: chunk_size = available
+                    chunk_size -= chunk_size % block_align
+                    return {
+                        "fmt": fmt,
+                        "channels": channels,
+                        "sample_rate": sample_rate,
+                        "block_align": block_align,
+                        "data_offset": data_offset,
+                        "data_size": chunk_size
+                    }
+                else:
+                    f.seek(chunk_size + (chunk_size % 2), 1)
+    except (OSError, struct.error):
+        return None
+
+def wav_duration(info):
+    """Exact duration in seconds from the sample count of a read_wav_info() result."""
+    return info["data_size"] / float(info["sample_rate"] * info["block_align"])
+
+def merge_wav_files(input_paths, output_path):
+    """
+    Concatenate WAV files that share one format by streaming their data chunks
+    into a single output WAV. Returns False (writing nothing) when any input is
+    not a plain WAV or the formats differ, so the caller can fall back to ffmpeg.
+    """
+    infos = [read_wav_info(p) for p in input_paths]
+    if not infos or any(i is None for i in infos): return False
+    fmt = infos[0]["fmt"]
+    if any(i["fmt"] != fmt for i in infos): return False
+    total = sum(i["data_size"] for i in infos)
+    fmt_chunk = b'fmt ' + struct.pack('<I', len(fmt)) + fmt + (b'\0' if len(fmt) % 2 else b'')
+    riff_size = 4 + len(fmt_chunk) + 8 + total
+    if riff_size > 0xFFFFFFFF: return False
+    
+    with open(output_path, 'wb') as out:
+        out.write(b'RIFF' + struct.pack('<I', riff_size) + b'WAVE')
+        out.write(fmt_chunk)
+        out.write(b'data' + struct.pack('<I', total))
+        for path, info in zip(input_paths, infos):
+            with open(path, 'rb') as f:
+                f.seek(info["data_offset"])
+                remaining = info["data_size"]
+                while remaining > 0:
+                    buf = f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+                    if not buf: break
+                    out.write(buf)
+                    remaining -= len(buf)
+    return True
+
+def probe_media(file_path):
+    """
+    Duration, container and streams of a media file from a single ffprobe
+    call, memoized by (path, size, mtime) so repeated lookups on the same
+    upload do not spawn new processes. Returns a dict(duration, format_name,
+    bit_rate, has_video, has_audio, streams=[{index, codec_type, codec_name,
+    duration, sample_rate, channels, width, height}]) that callers must not
+    modify, or None if ffprobe is unavailable or fails.
+    """
+    if not shutil.which("ffprobe"): return None
+    try:
+        st = os.stat(file_path)
+        return _probe_media_cached(os.path.abspath(file_path), st.st_size, st.st_mtime_ns)
+    except (OSError, ValueError, subprocess.CalledProcessError) as e:
+        print(f"ffprobe failed for {file_path}: {e}", file=sys.stderr)
+        return None
+
+def _float_or_zero(value):
+    try: return float(value)
+    except (TypeError, ValueError): return 0.0
+
+@functools.lru_cache(maxsize=256)
+def _probe_media_cached(file_path, size, mtime_ns):
+    cmd = ["ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", file_path]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    data = json.loads(result.stdout or "{}")
+    fmt = data.get("format") or {}
+    streams = []
+    for st in data.get("streams") or []:
+        # Cover art in audio files shows up as a one-frame video stream
+        if st.get("codec_type") == "video" and (st.get("disposition") or {}).get("attached_pic"): continue
+        streams.append({
+            "index": st.get("index"),
+            "codec_type": st.get("codec_type"),
+            "codec_name": st.get("codec_name"),
+            "duration": _float_or_zero(st.get("duration")),
+            "sample_rate": int(_float_or_zero(st.get("sample_rate"))) or None,
+            "channels": st.get("channels"),
+            "width": st.get("width"),
+            "height": st.get("height")
+        })
+    duration = _float_or_zero(fmt.get("duration")) or max([s["duration"] for s in streams] or [0.0])
+    return {
+        "duration": duration,
+        "format_name": fmt.get("format_name"),
+        "bit_rate": int(_float_or_zero(fmt.get("bit_rate"))) or None,
+        "has_video": any(s["codec_type"] == "video" for s in streams),
+        "has_audio": any(s["codec_type"] == "audio" for s in streams),
+        "streams": streams
+    }
+
+def get_audio_duration(file_path):
+    # WAV: exact duration from the header, no ffprobe process needed
+    wav_info = read_wav_info(file_path)
+    if wav_info: return wav_duration(wav_info)
+    info = probe_media(file_path)
+    return info["duration"] if info else 0
 
 def get_file_type(file_path):
     """
@@ -405,24 +1402,19 @@ def get_file_type(file_path):
     audio_extensions = ['.mp3', '.wav', '.m4a', '.ogg', '.flac', '.aac', '.wma', '.aiff']
     
     ext = os.path.splitext(file_path)[1].lower()
+    if ext == '.webm':
+        # yt-dlp's audio-only downloads are often WebM/Opus without a video stream
+        info = probe_media(file_path)
+        if info: return 'video' if info["has_video"] else 'audio'
     if ext in video_extensions:
         return 'video'
     elif ext in audio_extensions:
         return 'audio'
     
-    # If extension is ambiguous, use ffprobe to check
-    if shutil.which("ffprobe"):
-        try:
-            cmd = ["ffprobe", "-v", "error", "-select_streams", "v", 
-                   "-show_entries", "stream=codec_type", 
-                   "-of", "default=noprint_wrappers=1:nokey=1", file_path]
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            if result.stdout.strip():
-                return 'video'
-            else:
-                return 'audio'
-        except:
-            pass
+    # If extension is ambiguous, check the probed streams
+    info = probe_media(file_path)
+    if info and info["has_video"]:
+        return 'video'
     
     # Default to audio
     return 'audio'
@@ -437,37 +1429,44 @@ def convert_to_wav_16k(input_path, output_path):
     except Exception as e:
         return False, str(e)
 
-def convert_to_browser_compatible(input_path, original_ext):
+BROWSER_AUDIO_CONVERT = ['.m4a', '.wma', '.aac', '.flac', '.ogg', '.wav', '.aiff']
+BROWSER_VIDEO_CONVERT = ['.mkv', '.avi', '.mov', '.wmv', '.flv']
+
+def browser_target_ext(original_ext):
+    """Extension convert_to_browser_compatible will produce, or None if the file is served as is."""
+    ext = original_ext.lower()
+    # Audio: convert to MP3 (widely supported); video: convert non-browser formats to MP4.
+    # MP3, MP4/WebM and unknown formats are kept as is.
+    if ext in BROWSER_AUDIO_CONVERT: return '.mp3'
+    if ext in BROWSER_VIDEO_CONVERT: return '.mp4'
+    return None
+
+def convert_to_browser_compatible(input_path, original_ext, output_path=None):
     """
     Convert audio/video files to browser-compatible formats.
     - Audio: convert to MP3 (widely supported)
     - Video: keep as is if already MP4/WebM, otherwise convert to MP4
+    The result is written to output_path when given (e.g. straight into
+    tts_output), otherwise to a temp file.
     Returns: (success, converted_path, error)
     """
     if not shutil.which("ffmpeg"):
         return False, None, "ffmpeg missing"
     
+    target_ext = browser_target_ext(original_ext)
+    # If already MP3 or MP4/WebM (or unknown), no need to convert
+    if target_ext is None:
+        return True, input_path, None
+    
     try:
-        # Determine output format based on original file type
-        # Audio formats that should be converted
-        audio_formats = ['.m4a', '.wma', '.aac', '.flac', '.ogg', '.wav', '.aiff']
-        # Video formats - convert non-browser formats to MP4, keep MP4/WebM as is
-        video_formats_convert = ['.mkv', '.avi', '.mov', '.wmv', '.flv']
-        video_formats_keep = ['.mp4', '.webm']
-        
-        is_audio = original_ext.lower() in audio_formats
-        is_video_convert = original_ext.lower() in video_formats_convert
-        is_video_keep = original_ext.lower() in video_formats_keep
-        
-        # If already MP3 or MP4/WebM, no need to convert
-        if original_ext.lower() in ['.mp3'] or is_video_keep:
-            return True, input_path, None
-        
-        # Create temp file for conversion
-        fd, temp_path = tempfile.mkstemp(suffix='.mp3' if is_audio else '.mp4')
-        os.close(fd)
-        
-        if is_audio:
+        if output_path:
+            temp_path = output_path
+        else:
+            # Create temp file for conversion
+            fd, temp_path = tempfile.mkstemp(suffix=target_ext)
+            os.close(fd)
+        
+        if target_ext == '.mp3':
             # Convert audio to MP3 (better browser support)
             cmd = [
                 "ffmpeg", "-y", "-i", input_path,
@@ -475,7 +1474,7 @@ def convert_to_browser_compatible(input_path, original_ext):
                 "-q:a", "2",  # Good quality (0-9, lower is better)
                 temp_path
             ]
-        elif is_video_convert:
+        else:
             # Convert video to MP4 (H.264 + AAC for best compatibility)
             cmd = [
                 "ffmpeg", "-y", "-i", input_path,
@@ -487,9 +1486,6 @@ def convert_to_browser_compatible(input_path, original_ext):
                 "-movflags", "+faststart",  # Enable fast start for streaming
                 temp_path
             ]
-        else:
-            # Unknown format, try to keep as is
-            return True, input_path, None
         
         # Run conversion
         subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
@@ -498,8 +1494,33 @@ def convert_to_browser_compatible(input_path, original_ext):
         
     except Exception as e:
         print(f"Conversion failed: {e}", file=sys.stderr)
+        if output_path and os.path.exists(output_path):
+            os.remove(output_path)
         return False, None, str(e)
 
+def finish_browser_copy(source_path, source_ext, out_dir, saved_filename, transcode):
+    """
+    Wait for a browser transcode started next to ASR (transcode is a future of
+    convert_to_browser_compatible, or None if source_path is served as is).
+    If it failed, the original is served instead: a source outside out_dir is
+    renamed into it, not copied.
+    Returns (saved_filename, saved_path).
+    """
+    if transcode is None:
+        return os.path.basename(source_path), source_path
+    converted_success, converted_path, convert_error = transcode.result()
+    if converted_success:
+        return saved_filename, converted_path
+    
+    print(f"Conversion failed: {convert_error}, using original file", file=sys.stderr)
+    if os.path.dirname(os.path.abspath(source_path)) == os.path.abspath(out_dir):
+        return os.path.basename(source_path), source_path
+    # Keep original extension
+    saved_filename = f"asr-{uuid.uuid4()}{source_ext}"
+    saved_path = os.path.join(out_dir, saved_filename)
+    os.replace(source_path, saved_path)
+    return saved_filename, saved_path
+
 # --- Helper: Text Normalization ---
 def normalize_text_for_tts(text):
     if not text: return ""
@@ -511,25 +1532,38 @@ def normalize_text_for_tts(text):
     t = re.sub(r'[\r\n]+', '\n', t)
     return t.strip()
 
+# Characters after which split_text_for_say prefers to cut a segment
+_SAY_BOUNDARY_RE = re.compile(r'[\n。！？!?]')
+
 def split_text_for_say(text, max_len):
-    # Simple split by punctuation or space
+    """
+    Split text into chunks of at most max_len characters. Each chunk is cut
+    right after the last sentence end or newline in its window when that keeps
+    the chunk longer than half of max_len, otherwise at max_len.
+    Boundaries are located in one regex pass and consumed with a forward-only
+    cursor, so the whole split is linear in len(text).
+    """
     t = str(text)
+    n = len(t)
+    boundaries = [m.start() for m in _SAY_BOUNDARY_RE.finditer(t)]
     out = []
+    k = 0 # boundaries[:k] all lie before the current window end
     i = 0
-    while i < len(t):
-        j = min(i + max_len, len(t))
-        if j < len(t):
-            # Try to find split point
-            window = t[i:j]
-            match = re.search(r'(?:\n+|[。！？!?]\s*)', window[::-1])
-            if match:
-                offset = match.start()
+    while i < n:
+        j = min(i + max_len, n)
+        if j < n:
+            while k < len(boundaries) and boundaries[k] < j:
+                k += 1
+            if k > 0 and boundaries[k - 1] >= i:
+                # Distance from the window end back to the boundary character
+                offset = j - 1 - boundaries[k - 1]
                 if offset < max_len * 0.5: # If split point is reasonably far
                     j = j - offset
         
-        out.append(t[i:j].strip())
+        chunk = t[i:j].strip()
+        if chunk: out.append(chunk)
         i = j
-    return [c for c in out if c]
+    return out
 
 def estimate_subtitles_helper(text, duration):
     if duration <= 0 or not text: return []
@@ -592,14 +1626,33 @@ class AlibabaTTSBackend:
         voice_id = voice
         last_error = None
         
-        for model in MODEL_TTS_LIST:
+        # Serve from cache if any model has already synthesized this exact text
+        cache = get_tts_cache()
+        if cache:
+            keys = {tts_cache_key(model, voice_id, text): model for model in MODEL_TTS_LIST}
+            key, entry = cache.get_any(list(keys))
+            if entry:
+                print(f"TTS Cache Hit (Model: {keys[key]}): text_len={len(text)}", file=sys.stderr)
+                link_or_copy(entry["paths"][".wav"], output_path)
+                return True, None, entry.get("subtitles", [])
+        
+        quota_error = None
+        try:
+            health = get_model_health()
+            models = health.candidates(MODEL_TTS_LIST)
+        except Exception as e:
+            return False, f"TTS model selection failed: {e}", None
+        for model in models:
             # Retry logic for TTS API per model
             max_retries = 3
+            model_error = None # error of the last attempt that counts against the model's health
+            fatal = False
             for attempt in range(max_retries):
                 try:
                     # Use MultiModalConversation for qwen-tts
                     print(f"TTS Call (Model: {model}, Attempt {attempt+1}/{max_retries}): voice={voice_id}, text_len={len(text)}", file=sys.stderr)
                     
+                    get_rate_limiter().acquire(model)
                     response = MultiModalConversation.call(
                         model=model,
                         text=text,
@@ -611,12 +1664,8 @@ class AlibabaTTSBackend:
                         if hasattr(response.output, 'audio') and 'url' in response.output.audio:
                             audio_url = response.output.audio['url']
                             
-                            # Download the audio
-                            r = requests.get(audio_url)
-                            r.raise_for_status()
-                            
-                            with open(output_path, "wb") as f:
-                                f.write(r.content)
+                            # Stream the audio to disk over the pooled session
+                            download_to_file(audio_url, output_path)
                                 
                             # Fake subtitles (Estimate)
                             duration = get_audio_duration(output_path)
@@ -628,29 +1677,57 @@ class AlibabaTTSBackend:
                                     "start": s['begin_time'] / 1000.0,
                                     "end": s['end_time'] / 1000.0
                                 })
+                            if cache:
+                                cache.put(tts_cache_key(model, voice_id, text),
+                                          {"model": model, "voice": voice_id, "subtitles": subtitles},
+                                          {".wav": output_path})
+                            health.record_success(model)
                             return True, None, subtitles
                         else:
-                            last_error = f"Unexpected response format from {model}: {response}"
+                            last_error = model_error = f"Unexpected response format from {model}: {response}"
                             print(last_error, file=sys.stderr)
                             break # Try next model
                     else:
                         if "free tier of the model has been exhausted" in str(response.message):
-                             return False, "阿里云DashScope Qwen-TTS模型免费额度已耗尽。请前往阿里云控制台开启“按量付费”或购买资源包以继续使用。", None
+                            # Quota is per model, so the next model may still work
+                            quota_error = "阿里云DashScope Qwen-TTS模型免费额度已耗尽。请前往阿里云控制台开启“按量付费”或购买资源包以继续使用。"
+                            last_error = model_error = f"TTS API Error ({model}): {response.message}"
+                            fatal = True
+                            break # Try next model
+                        
+                        if is_rate_limited(response.status_code, f"{response.code} {response.message}"):
+                            print(f"TTS Throttled ({model}): {response.message}, retrying...", file=sys.stderr)
+                            get_rate_limiter().penalize(model, 2 ** attempt)
+                            model_error = None
+                            continue # Retry same model once the bucket reopens
                         
                         # Check for 500 InternalError.Algo which might be transient
                         if response.status_code == 500 and "InternalError.Algo" in str(response.message):
                             print(f"TTS Transient Error ({model}): {response.message}, retrying...", file=sys.stderr)
-                            time.sleep(1 + attempt) # Backoff
+                            get_rate_limiter().penalize(model, 1 + attempt) # Backoff
+                            model_error = f"TTS API Error ({model}): {response.message}"
                             continue # Retry same model
                         
-                        last_error = f"TTS API Error ({model}): {response.message}"
+                        last_error = model_error = f"TTS API Error ({model}): {response.message}"
+                        fatal = is_model_unavailable(f"{response.code} {response.message}")
                         print(last_error, file=sys.stderr)
                         break # Try next model
+                
+                except requests.exceptions.RequestException as e:
+                    # Audio download failed (timeout, dropped connection, short body)
+                    last_error = f"TTS audio download failed ({model}): {e}"
+                    model_error = None # the model answered; the CDN download failed
+                    print(f"{last_error}, retrying...", file=sys.stderr)
+                    time.sleep(retry_after_seconds(getattr(e, "response", None), 1 + attempt))
+                    continue # Retry same model
                         
                 except Exception as e:
                     error_msg = str(e)
                     if "AllocationQuota.FreeTierOnly" in error_msg or "free tier" in error_msg.lower():
-                        return False, "阿里云DashScope免费额度已耗尽。请前往阿里云控制台开启“按量付费”或购买资源包以继续使用。(错误代码: AllocationQuota.FreeTierOnly)", None
+                        quota_error = "阿里云DashScope免费额度已耗尽。请前往阿里云控制台开启“按量付费”或购买资源包以继续使用。(错误代码: AllocationQuota.FreeTierOnly)"
+                        last_error = model_error = f"Exception ({model}): {error_msg}"
+                        fatal = True
+                        break # Try next model
                     
                     # Check for 500 in exception message if wrapped
                     if ("500" in error_msg and "InternalError" in error_msg) or \
@@ -658,167 +1735,767 @@ class AlibabaTTSBackend:
                        ("502" in error_msg) or \
                        ("ConnectionError" in error_msg):
                          print(f"TTS Exception ({model} - Transient?): {error_msg}, retrying...", file=sys.stderr)
-                         time.sleep(1 + attempt)
+                         get_rate_limiter().penalize(model, 1 + attempt)
+                         model_error = f"Exception ({model}): {error_msg}"
+                         continue # Retry same model
+                    
+                    if is_rate_limited(None, error_msg):
+                         print(f"TTS Throttled ({model}): {error_msg}, retrying...", file=sys.stderr)
+                         get_rate_limiter().penalize(model, 2 ** attempt)
+                         model_error = None
                          continue # Retry same model
                     
-                    last_error = f"Exception ({model}): {error_msg}"
+                    last_error = model_error = f"Exception ({model}): {error_msg}"
+                    fatal = is_model_unavailable(error_msg)
                     print(last_error, file=sys.stderr)
                     break # Try next model
+            
+            if model_error:
+                health.record_failure(model, model_error, fatal=fatal)
         
+        if quota_error: return False, quota_error, None
         return False, f"All TTS models failed. Last error: {last_error}", None
 
-    def estimate_subtitles(self, text, duration):
-        # Legacy method kept for compatibility if needed, but generate() uses helper now.
-        # Actually generate() uses local logic above.
-        pass
+    def estimate_subtitles(self, text, duration):
+        # Legacy method kept for compatibility if needed, but generate() uses helper now.
+        # Actually generate() uses local logic above.
+        pass
+
+def iter_synthesized_segments(backend, segments, voice, out_dir, concurrency=TTS_MAX_CONCURRENCY, reuse=None):
+    """
+    Synthesize text segments with at most `concurrency` calls in flight.
+    reuse maps segment index -> (wav_path, subtitles) of audio that is already
+    available (see plan_segment_reuse); those segments are linked, not synthesized.
+    Yields (index, ok, error, seg_path, subtitles) in segment order, each as soon
+    as it and all segments before it are done.
+    """
+    reuse = reuse or {}
+
+    def _synth(i):
+        seg_path = os.path.join(out_dir, f"seg_{i}.wav")
+        if i in reuse:
+            src_path, subs = reuse[i]
+            link_or_copy(src_path, seg_path)
+            return True, None, seg_path, [dict(s) for s in subs]
+        ok, err, subs = backend.generate(segments[i], voice, seg_path)
+        return ok, err, seg_path, subs
+
+    pool = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    futures = [pool.submit(_synth, i) for i in range(len(segments))]
+    try:
+        for i, fut in enumerate(futures):
+            yield (i,) + fut.result()
+    finally:
+        # Consumer stopped early (failure or client disconnect): drop pending segments
+        for f in futures: f.cancel()
+        pool.shutdown(wait=True)
+
+def synthesize_segments(backend, segments, voice, out_dir, concurrency=TTS_MAX_CONCURRENCY, reuse=None):
+    """
+    Synthesize all segments, see iter_synthesized_segments.
+    Returns: (success, error, [(seg_path, subtitles), ...]) in segment order.
+    """
+    results = []
+    gen = iter_synthesized_segments(backend, segments, voice, out_dir, concurrency, reuse)
+    try:
+        for i, ok, err, seg_path, subs in gen:
+            if not ok: return False, f"Segment {i} failed: {err}", None
+            results.append((seg_path, subs))
+    finally:
+        gen.close()
+    return True, None, results
+
+# --- Helper: Incremental TTS ---
+# Segmented requests keep their segment WAVs in tts_output/tts_parts/<tts_id>/ with a
+# manifest of segment hashes, so a later request can pass base_id=<tts_id> and
+# only synthesize the segments whose text changed.
+TTS_ID_RE = re.compile(r'^tts-[0-9a-f-]{36}$')
+
+def tts_parts_path(tts_id):
+    return os.path.join(get_output_dir(), "tts_parts", tts_id)
+
+def tts_parts_dir(filename):
+    """Return (tts_id, parts_dir) for an output filename such as tts-<uuid>.wav."""
+    tts_id = os.path.splitext(filename)[0]
+    parts_dir = tts_parts_path(tts_id)
+    os.makedirs(parts_dir, exist_ok=True)
+    return tts_id, parts_dir
+
+def tts_segment_hash(voice, text):
+    return hashlib.sha256(f"{voice}\0{text}".encode('utf-8')).hexdigest()
+
+def write_tts_manifest(parts_dir, voice, segments, results):
+    """Record each segment's hash, WAV file and segment-relative subtitles."""
+    manifest = {
+        "voice": voice,
+        "segments": [
+            {"hash": tts_segment_hash(voice, seg), "file": os.path.basename(path), "subtitles": subs}
+            for seg, (path, subs) in zip(segments, results)
+        ]
+    }
+    try:
+        with open(os.path.join(parts_dir, "manifest.json"), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+    except OSError as e:
+        print(f"Failed to write TTS manifest: {e}", file=sys.stderr)
+
+def plan_segment_reuse(base_id, segments, voice):
+    """
+    Diff segments against the manifest of a previous request.
+    Returns {segment index: (wav_path, subtitles)} for segments that can be reused.
+    """
+    if not base_id or not TTS_ID_RE.match(str(base_id)): return {}
+    base_dir = tts_parts_path(base_id)
+    try:
+        with open(os.path.join(base_dir, "manifest.json"), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        print(f"TTS base {base_id} not found, synthesizing everything", file=sys.stderr)
+        return {}
+    
+    by_hash = {}
+    for entry in manifest.get("segments", []):
+        path = os.path.join(base_dir, entry["file"])
+        if os.path.exists(path): by_hash.setdefault(entry["hash"], (path, entry.get("subtitles", [])))
+    
+    reuse = {}
+    for i, seg in enumerate(segments):
+        hit = by_hash.get(tts_segment_hash(voice, seg))
+        if hit: reuse[i] = hit
+    print(f"TTS Incremental: reusing {len(reuse)}/{len(segments)} segments from {base_id}", file=sys.stderr)
+    return reuse
+
+def merge_audio_files(seg_files, output_path):
+    """Concatenate same-format audio files into output_path. Returns (success, error)."""
+    if len(seg_files) == 1:
+        link_or_copy(seg_files[0], output_path)
+        return True, None
+    # Same-format WAV segments are merged in-process; ffmpeg only for mismatches
+    if merge_wav_files(seg_files, output_path):
+        return True, None
+    print("WAV formats differ, merging with ffmpeg", file=sys.stderr)
+    # The concat filter decodes every input and converts them to one format;
+    # the concat demuxer with -c copy would keep the first header over mixed PCM
+    cmd = ["ffmpeg", "-y"]
+    for p in seg_files: cmd += ["-i", p]
+    streams = "".join(f"[{i}:a]" for i in range(len(seg_files)))
+    cmd += ["-filter_complex", f"{streams}concat=n={len(seg_files)}:v=0:a=1[out]", "-map", "[out]", output_path]
+    try:
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return True, None
+    except Exception as e:
+        return False, f"Merge failed: {e}"
+
+def sse_event(event, data):
+    """Format one Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def stream_tts(backend, text, voice, filename, concurrency=TTS_MAX_CONCURRENCY, base_id=None):
+    """
+    SSE generator for progressive TTS. Segment WAVs are kept under
+    tts_output/tts_parts/<tts_id>/ so the client can start playing segment 1 while
+    the rest are still being synthesized (and removed again if the stream fails). Emits:
+      segment: {index, total, audio_url, start, duration, subtitles, reused}
+      done:    {audio_url, subtitles, download_filename, tts_id, reused_segments}
+      error:   {error}
+    """
+    out_dir = get_output_dir()
+    tts_id, parts_dir = tts_parts_dir(filename)
+    
+    segments = split_text_for_say(text, MAX_SAY_SEGMENT_LENGTH)
+    reuse = plan_segment_reuse(base_id, segments, voice)
+    print(f"TTS Stream: {len(segments)} segments, concurrency={concurrency}", file=sys.stderr)
+    
+    results = []
+    all_subs = []
+    current_offset = 0.0
+    gen = iter_synthesized_segments(backend, segments, voice, parts_dir, concurrency, reuse)
+    finished = False
+    try:
+        for i, ok, err, seg_path, subs in gen:
+            if not ok:
+                yield sse_event("error", {"error": f"Segment {i} failed: {err}"})
+                return
+            results.append((seg_path, [dict(s) for s in subs]))
+            dur = get_audio_duration(seg_path)
+            for s in subs:
+                s['start'] += current_offset
+                s['end'] += current_offset
+            yield sse_event("segment", {
+                "index": i,
+                "total": len(segments),
+                "audio_url": f"/tts_output/tts_parts/{tts_id}/{os.path.basename(seg_path)}",
+                "start": current_offset,
+                "duration": dur,
+                "subtitles": subs,
+                "reused": i in reuse
+            })
+            all_subs.extend(subs)
+            current_offset += dur
+        
+        write_tts_manifest(parts_dir, voice, segments, results)
+        ok, err = merge_audio_files([p for p, _ in results], os.path.join(out_dir, filename))
+        if not ok:
+            yield sse_event("error", {"error": err})
+            return
+        finished = True
+        yield sse_event("done", {
+            "audio_url": f"/tts_output/{filename}",
+            "subtitles": all_subs,
+            "download_filename": filename,
+            "tts_id": tts_id,
+            "reused_segments": len(reuse)
+        })
+    finally:
+        gen.close()
+        # A failed or abandoned stream leaves nothing to build on
+        if not finished: shutil.rmtree(parts_dir, ignore_errors=True)
+
+# --- Backend: Alibaba ASR ---
+_SILENCE_START_RE = re.compile(r'silence_start:\s*(-?[\d.]+)')
+_SILENCE_END_RE = re.compile(r'silence_end:\s*(-?[\d.]+)')
+_FFMPEG_DURATION_RE = re.compile(r'Duration:\s*(\d+):(\d+):([\d.]+)')
+
+def scan_audio(input_path):
+    """
+    One decode pass over input_path as 16 kHz mono PCM that yields both the
+    content fingerprint (SHA-256 of the decoded samples, so the same recording
+    in another container or with different metadata still matches) and an
+    energy scan with ffmpeg's silencedetect filter.
+    Memoized by (path, size, mtime). Returns dict(fingerprint, silences, duration)
+    with silences as [(start, end), ...] seconds and duration 0 if unknown. The
+    duration is counted from the decoded samples, since the container header
+    can underestimate it (VBR MP3 without a Xing header).
+    """
+    st = os.stat(input_path)
+    return _scan_audio_cached(input_path, st.st_size, st.st_mtime_ns)
+
+@functools.lru_cache(maxsize=32)
+def _scan_audio_cached(input_path, size, mtime_ns):
+    cmd = ["ffmpeg", "-hide_banner", "-nostats", "-i", input_path,
+           "-vn", "-ac", "1", "-ar", "16000",
+           "-af", f"silencedetect=noise={ASR_SILENCE_NOISE_DB}dB:d={ASR_SILENCE_MIN_PAUSE}",
+           "-f", "s16le", "-"]
+    digest = hashlib.sha256()
+    pcm_bytes = 0
+    with tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err)
+        for buf in iter(lambda: proc.stdout.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(buf)
+            pcm_bytes += len(buf)
+        proc.stdout.close()
+        if proc.wait() != 0: raise subprocess.CalledProcessError(proc.returncode, cmd)
+        err.seek(0)
+        stderr = err.read().decode('utf-8', errors='ignore')
+    
+    # 16 kHz mono s16le: 32000 bytes per second; the header duration only if nothing was decoded
+    total = pcm_bytes / 32000.0
+    m = _FFMPEG_DURATION_RE.search(stderr)
+    if m and not total: total = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+    
+    silences = []
+    start = None
+    for line in stderr.splitlines():
+        m = _SILENCE_START_RE.search(line)
+        if m: start = max(0.0, float(m.group(1)))
+        m = _SILENCE_END_RE.search(line)
+        if m and start is not None:
+            silences.append((start, float(m.group(1))))
+            start = None
+    if start is not None and total > start:
+        silences.append((start, total)) # Trailing silence runs to the end
+    return {"fingerprint": f"pcm-{digest.hexdigest()}", "silences": silences, "duration": total}
+
+def audio_fingerprint(input_path):
+    """Content key for ASR result caching: decoded-audio hash, else a hash of the file bytes."""
+    if shutil.which("ffmpeg"):
+        try:
+            return scan_audio(input_path)["fingerprint"]
+        except Exception as e:
+            print(f"Audio decode for fingerprint failed ({e}), hashing file bytes", file=sys.stderr)
+    digest = hashlib.sha256()
+    with open(input_path, 'rb') as f:
+        for buf in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(buf)
+    return f"bytes-{digest.hexdigest()}"
+
+def plan_asr_chunks(silences, total, chunk_duration=ASR_CHUNK_DURATION):
+    """
+    Plan which audio to upload and where to cut it.
+    Returns {"keep": [(start, end), ...], "cuts": [t, ...], "open_end": bool}:
+    "keep" are the spans of the original timeline left after dropping silences
+    longer than ASR_SILENCE_DROP_MIN, "cuts" are chunk boundaries on the
+    compacted timeline (kept spans back to back), placed in pauses wherever
+    possible. open_end is True if the last span runs to the end of the audio.
+    """
+    keep = []
+    pauses = [] # pause midpoints on the compacted timeline
+    pos = 0.0
+    compact = 0.0
+    for s, e in silences:
+        if e - s >= ASR_SILENCE_DROP_MIN:
+            cut_start, cut_end = s + ASR_SILENCE_KEEP_PAD, e - ASR_SILENCE_KEEP_PAD
+            if cut_start > pos:
+                keep.append((pos, cut_start))
+                compact += cut_start - pos
+            pauses.append(compact)
+            pos = cut_end
+        else:
+            pauses.append(compact + (s + e) / 2.0 - pos)
+    open_end = total > pos
+    if open_end:
+        keep.append((pos, total))
+        compact += total - pos
+    
+    cuts = []
+    chunk_start = 0.0
+    k = 0
+    while compact - chunk_start > chunk_duration:
+        limit = chunk_start + chunk_duration
+        # Latest pause in the back half of the window, else a hard cut
+        while k < len(pauses) and pauses[k] <= limit: k += 1
+        cut = pauses[k - 1] if k > 0 and pauses[k - 1] > chunk_start + chunk_duration * 0.5 else limit
+        cuts.append(cut)
+        chunk_start = cut
+    return {"keep": keep, "cuts": cuts, "open_end": open_end}
+
+def map_to_original_time(plan, t):
+    """Map a time (seconds) on the compacted timeline of plan back to the original audio."""
+    keep = plan["keep"]
+    if not keep: return t
+    starts = plan.get("_compact_starts")
+    if starts is None:
+        starts, acc = [], 0.0
+        for s, e in keep:
+            starts.append(acc)
+            acc += e - s
+        plan["_compact_starts"] = starts
+    i = max(0, bisect.bisect_right(starts, t) - 1)
+    s, e = keep[i]
+    return min(s + (t - starts[i]), e)
+
+def preprocess_for_asr(input_path, out_dir, chunk_duration=ASR_CHUNK_DURATION, plan=None):
+    """
+    Decode input_path once and write 16 kHz mono 64k MP3 chunks of at most
+    chunk_duration seconds into out_dir with ffmpeg's segment muxer. With a
+    plan from plan_asr_chunks only the kept spans are encoded and chunks are
+    cut at the planned points.
+    Returns [(chunk_path, duration_seconds), ...] in order, with durations taken
+    from the muxer's segment list instead of probing every chunk.
+    """
+    list_path = os.path.join(out_dir, "chunks.csv")
+    seg_pattern = os.path.join(out_dir, "chunk_%03d.mp3")
+    # -ac 1: mono
+    # -b:a 64k: slightly higher bitrate to avoid artifacts
+    # Re-encoding (not '-c copy') ensures every chunk is a valid standalone file
+    cmd = ["ffmpeg", "-y", "-i", input_path, "-vn"]
+    if plan:
+        spans = [f"between(t,{s:.3f},{e:.3f})" for s, e in plan["keep"]]
+        if plan.get("open_end"):
+            # Whatever follows the last span is kept too, in case the audio runs past the scanned length
+            spans[-1] = f"gte(t,{plan['keep'][-1][0]:.3f})"
+        select = "+".join(spans)
+        cmd += ["-af", f"aselect='{select}',asetpts=N/SR/TB"]
+    cmd += ["-ar", "16000", "-ac", "1", "-b:a", "64k", "-f", "segment"]
+    if plan and plan["cuts"]:
+        cmd += ["-segment_times", ",".join(f"{c:.3f}" for c in plan["cuts"])]
+    elif not plan:
+        cmd += ["-segment_time", str(chunk_duration)]
+    else:
+        cmd += ["-segment_time", str(chunk_duration * 2)] # Everything fits in one chunk
+    cmd += ["-reset_timestamps", "1",
+            "-segment_list", list_path, "-segment_list_type", "csv",
+            seg_pattern]
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    
+    chunks = []
+    with open(list_path, 'r', newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 3: continue
+            chunks.append((os.path.join(out_dir, row[0]), float(row[2]) - float(row[1])))
+    if not chunks: raise RuntimeError("ffmpeg produced no ASR chunks")
+    return chunks
+
+def read_segment_list(list_path):
+    """Complete rows of an ffmpeg csv segment list as [(chunk_path, duration_seconds), ...]."""
+    try:
+        with open(list_path, 'r', newline='') as f:
+            data = f.read()
+    except OSError:
+        return []
+    chunks = []
+    # The muxer appends one row per closed segment; a row without newline is still being written
+    for row in csv.reader(data[:data.rfind("\n") + 1].splitlines()):
+        if len(row) < 3: continue
+        chunks.append((os.path.join(os.path.dirname(list_path), row[0]), float(row[2]) - float(row[1])))
+    return chunks
+
+def segment_stream_for_asr(tail, out_dir, chunk_duration=ASR_CHUNK_DURATION):
+    """
+    preprocess_for_asr for a download in progress: ffmpeg decodes the bytes
+    of tail (a DownloadTail) from a pipe into fixed-length chunks, and each
+    (chunk_path, duration_seconds) is yielded as soon as the segment muxer
+    has closed it. There is no silence plan, since that needs the whole file.
+    Raises RuntimeError if ffmpeg fails, e.g. on an MP4 whose index is at the
+    end of the file and cannot be read from a pipe.
+    """
+    list_path = os.path.join(out_dir, "chunks.csv")
+    seg_pattern = os.path.join(out_dir, "chunk_%03d.mp3")
+    cmd = ["ffmpeg", "-y", "-i", "pipe:0", "-vn",
+           "-ar", "16000", "-ac", "1", "-b:a", "64k",
+           "-f", "segment", "-segment_time", str(chunk_duration), "-reset_timestamps", "1",
+           "-segment_list", list_path, "-segment_list_type", "csv",
+           seg_pattern]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    
+    def feed():
+        try:
+            for buf in tail.chunks():
+                proc.stdin.write(buf)
+        except OSError:
+            pass # ffmpeg gave up on the input; its exit code says so
+        finally:
+            try: proc.stdin.close()
+            except OSError: pass
+    threading.Thread(target=feed, daemon=True).start()
+    
+    emitted = 0
+    try:
+        while True:
+            exited = proc.poll() is not None
+            chunks = read_segment_list(list_path)
+            for chunk in chunks[emitted:]:
+                emitted += 1
+                yield chunk
+            if exited: break
+            time.sleep(ASR_STREAM_POLL_INTERVAL)
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+    if proc.returncode != 0: raise RuntimeError(f"ffmpeg failed to segment the download (exit code {proc.returncode})")
+    if not emitted: raise RuntimeError("ffmpeg produced no ASR chunks")
+
+def plan_asr_preprocessing(input_path, task_id):
+    """Silence scan + chunk plan for input_path, or None to fall back to fixed-length chunks."""
+    if not ASR_SILENCE_TRIM: return None
+    try:
+        scan = scan_audio(input_path)
+        silences, total = scan["silences"], scan["duration"]
+    except Exception as e:
+        print(f"ASR [Task ID: {task_id}]: Silence scan failed ({e}), using fixed chunks", file=sys.stderr)
+        return None
+    if total <= 0: return None
+    plan = plan_asr_chunks(silences, total)
+    kept = sum(e - s for s, e in plan["keep"])
+    if kept <= 0: return None
+    print(f"ASR [Task ID: {task_id}]: Silence scan: uploading {kept:.1f}s of {total:.1f}s in {len(plan['cuts']) + 1} chunks", file=sys.stderr)
+    return plan
+
+# Known model hallucinations/prefixes removed from ASR output
+ASR_BAD_PREFIXES = [
+    "这段音频的原始内容是",
+    "这段音频的内容是",
+    "音频内容是",
+    "转写结果如下",
+    "请准确转写",
+    "这段音频"
+]
+_ASR_REPEAT_RE = re.compile(r'(.)\1{3,}')
+_ASR_DOUBLE_PUNCT_RE = re.compile(r'([，。！？；：,.!?;:])\1+')
+_ASR_PUNCT_SPACE_RE = re.compile(r'\s*([，。！？；：,.!?;:])\s*')
+# Sentence ends after which the text can be cleaned on its own with the same result as cleaning
+# it together with what follows: the next character must not be whitespace, punctuation or the
+# start of a bad prefix, so no cleanup rule can match across the cut
+_ASR_SENTENCE_ENDS = "。！？!?"
+_ASR_SAFE_CUT_RE = re.compile(
+    "[" + _ASR_SENTENCE_ENDS + "](?=[^\\s，。！？；：,.!?;:" + "".join(sorted({p[0] for p in ASR_BAD_PREFIXES})) + "])"
+)
+
+def clean_asr_hallucinations(t):
+    """Strip known model prefixes, squashed repeats and doubled punctuation from a chunk transcript."""
+    if not t: return ""
+    t = str(t)
+    
+    # 0. Remove known model hallucinations/prefixes
+    for p in ASR_BAD_PREFIXES:
+        t = t.replace(p, "")
+        
+    # 1. Squash repeated characters (often hallucinations)
+    # Replace any character repeated 4 or more times with a single instance
+    t = _ASR_REPEAT_RE.sub(r'\1', t)
+    
+    # 2. Basic punctuation cleanup (as safeguard)
+    # Fix double punctuation from raw output
+    t = _ASR_DOUBLE_PUNCT_RE.sub(r'\1', t)
+    # Fix space around punctuation
+    t = _ASR_PUNCT_SPACE_RE.sub(r'\1', t)
+    
+    # 3. Trim
+    return t.strip()
+
+class StreamAssembler:
+    """
+    Collects streamed model deltas in lists instead of repeated string +=,
+    and cleans each completed sentence with clean_asr_hallucinations as soon
+    as it is safe to, so the cleaned transcript is ready when the stream ends.
+    Also measures time to first token and output tokens per second.
+    """
+    def __init__(self):
+        self.started = time.monotonic()
+        self.first_token_at = None
+        self.finished_at = None
+        self.output_tokens = None
+        self._raw = []
+        self._pending = []
+        self._pending_has_end = False
+        self._cleaned = []
+
+    def feed(self, delta):
+        if not delta: return
+        if self.first_token_at is None: self.first_token_at = time.monotonic()
+        self._raw.append(delta)
+        self._pending.append(delta)
+        if self._pending_has_end or any(c in delta for c in _ASR_SENTENCE_ENDS):
+            self._flush_sentences()
+
+    def _flush_sentences(self):
+        pending = "".join(self._pending)
+        cut = None
+        for m in _ASR_SAFE_CUT_RE.finditer(pending):
+            cut = m.end()
+        if cut:
+            self._cleaned.append(clean_asr_hallucinations(pending[:cut]))
+            pending = pending[cut:]
+        self._pending = [pending]
+        self._pending_has_end = any(c in pending for c in _ASR_SENTENCE_ENDS)
+
+    def finish(self, output_tokens=None):
+        """Close the stream; output_tokens comes from the response usage if the API reports it."""
+        self.finished_at = time.monotonic()
+        self.output_tokens = output_tokens
+        self._cleaned.append(clean_asr_hallucinations("".join(self._pending)))
+        self._pending = []
+        return self.text()
+
+    def raw_text(self):
+        return "".join(self._raw)
+
+    def text(self):
+        """Cleaned text of everything up to the last safe sentence end (all of it once finished)."""
+        return "".join(self._cleaned)
+
+    def metrics(self):
+        """{"ttft": seconds to first token, "tokens_per_s": output speed after the first token}; None if unknown."""
+        if self.first_token_at is None: return {"ttft": None, "tokens_per_s": None}
+        end = self.finished_at or time.monotonic()
+        tokens = self.output_tokens or len(self.raw_text())
+        gen_time = end - self.first_token_at
+        return {
+            "ttft": round(self.first_token_at - self.started, 3),
+            "tokens_per_s": round(tokens / gen_time, 1) if gen_time > 0 else None
+        }
+
+def chunk_subtitles(text, chunk_dur, offset_ms, plan=None):
+    """Estimated subtitles of one cleaned chunk transcript, shifted to the chunk's offset and, with a plan, mapped back to the original audio."""
+    subs = estimate_subtitles_helper(text, chunk_dur)
+    for sub in subs:
+        sub['begin_time'] += offset_ms
+        sub['end_time'] += offset_ms
+        if plan:
+            # Subtitles were timed on the silence-trimmed audio
+            sub['begin_time'] = int(map_to_original_time(plan, sub['begin_time'] / 1000.0) * 1000)
+            sub['end_time'] = int(map_to_original_time(plan, sub['end_time'] / 1000.0) * 1000)
+    return subs
+
+def save_chunk_layout(checkpoint_dir, chunks, plan, streamed=False, complete=True):
+    """
+    Record chunk durations and the silence plan so checkpoints can be placed on the timeline by other workers.
+    streamed: chunks are cut from a download in progress (see segment_stream_for_asr) and their
+    checkpoints have no total; complete is False until the last one has been cut.
+    """
+    if not checkpoint_dir: return
+    try:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        write_json_atomic(os.path.join(checkpoint_dir, "layout.json"), {
+            "durations": [d for _, d in chunks],
+            "plan": {"keep": plan["keep"]} if plan else None,
+            "streamed": streamed,
+            "complete": complete
+        })
+    except OSError as e:
+        print(f"Failed to write ASR chunk layout: {e}", file=sys.stderr)
 
-# --- Backend: Alibaba ASR ---
-def run_ali_asr(file_path, api_key, task_id):
-    """Run ASR with task ID for progress tracking"""
+def load_chunk_layout(checkpoint_dir):
+    try:
+        with open(os.path.join(checkpoint_dir, "layout.json"), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def run_ali_asr(file_path, api_key, task_id, checkpoint_dir=None, chunk_source=None):
+    """
+    Run ASR with task ID for progress tracking.
+    With checkpoint_dir, every finished chunk is saved there and chunks that
+    already have a checkpoint are not sent to the model again.
+    chunk_source replaces the preprocessing of file_path: a callable taking a
+    scratch directory and yielding (chunk_path, duration) while the chunks are
+    still being produced (see segment_stream_for_asr); each chunk is sent to
+    the model as soon as it arrives.
+    """
     dashscope.api_key = api_key
     print(f"ASR [Task ID: {task_id}]: Starting ASR processing", file=sys.stderr)
     
-    # 1. Compress/Extract to mp3
-    compressed_path = file_path
-    is_temp = False
-    
-    if shutil.which("ffmpeg"):
-        try:
-            fd, temp_path = tempfile.mkstemp(suffix=".mp3")
-            os.close(fd)
-            # -ac 1: mono
-            # -b:a 64k: slightly higher bitrate to avoid artifacts
-            cmd = ["ffmpeg", "-y", "-i", file_path, 
-                   "-vn", "-ar", "16000", "-ac", "1", "-b:a", "64k", 
-                   temp_path]
-            subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-            compressed_path = temp_path
-            is_temp = True
-        except Exception as e:
-            print(f"ASR Compression Warning: {e}", file=sys.stderr)
-            is_temp = False
-            compressed_path = file_path
-
-    # 2. Check Duration and Chunk if necessary
-    # Qwen-Audio has timeout issues on long files. We split if > 300s.
-    CHUNK_DURATION = 300
-    duration = get_audio_duration(compressed_path)
-    
     final_text = ""
     all_sentences = []
+    failed_chunks = 0
+    resumed_chunks = 0
     
-    # Local helper for cleanup
-    def clean_asr_hallucinations(t):
-        if not t: return ""
-        t = str(t)
-        
-        # 0. Remove known model hallucinations/prefixes
-        bad_prefixes = [
-            "这段音频的原始内容是",
-            "这段音频的内容是",
-            "音频内容是",
-            "转写结果如下",
-            "请准确转写",
-            "这段音频"
-        ]
-        for p in bad_prefixes:
-            t = t.replace(p, "")
-            
-        # 1. Squash repeated characters (often hallucinations)
-        # Replace any character repeated 4 or more times with a single instance
-        t = re.sub(r'(.)\1{3,}', r'\1', t)
+    chunk_dir = tempfile.mkdtemp()
+    try:
+        # 1. Extract, downmix, compress and split in a single ffmpeg pass
+        chunks = None
+        plan = None
+        if chunk_source is not None:
+            chunks = []
+        elif shutil.which("ffmpeg"):
+            plan = plan_asr_preprocessing(file_path, task_id)
+            try:
+                chunks = preprocess_for_asr(file_path, chunk_dir, plan=plan)
+            except Exception as e:
+                print(f"ASR Compression Warning: {e}", file=sys.stderr)
+                if plan:
+                    # Retry with plain fixed-length chunks
+                    plan = None
+                    try: chunks = preprocess_for_asr(file_path, chunk_dir)
+                    except Exception as e2: print(f"ASR Compression Warning: {e2}", file=sys.stderr)
+        if chunk_source is None and not chunks:
+            chunks = [(file_path, get_audio_duration(file_path))]
         
-        # 2. Basic punctuation cleanup (as safeguard)
-        # Fix double punctuation from raw output
-        t = re.sub(r'([，。！？；：,.!?;:])\1+', r'\1', t)
-        # Fix space around punctuation
-        t = re.sub(r'\s*([，。！？；：,.!?;:])\s*', r'\1', t)
+        save_chunk_layout(checkpoint_dir, chunks, plan, streamed=chunk_source is not None, complete=chunk_source is None)
         
-        # 3. Trim
-        return t.strip()
-
-    try:
-        if duration <= CHUNK_DURATION:
+        def transcribe_chunk(i, chunk, chunk_dur):
+            # A streamed chunk's checkpoint has no total, since the chunk count is only known at the end
+            total = None if chunk_source is not None else len(chunks)
+            text = load_chunk_checkpoint(checkpoint_dir, i, total, chunk_dur)
+            if text is not None:
+                print(f"ASR [Task ID: {task_id}]: Chunk #{i+1} restored from checkpoint", file=sys.stderr)
+                return True, text, chunk_dur, True
+            print(f"ASR [Task ID: {task_id}]: Transcribing chunk #{i+1}", file=sys.stderr)
+            ok, res = _call_qwen_audio(chunk, task_id)
+            if ok:
+                # Convert to string
+                if isinstance(res, list):
+                    res = " ".join([str(x) for x in res])
+                elif not isinstance(res, str):
+                    res = str(res)
+                save_chunk_checkpoint(checkpoint_dir, i, total, chunk_dur, res)
+            return ok, res, chunk_dur, False
+        
+        single = None
+        if chunk_source is not None:
+            # Transcribe every chunk as soon as ffmpeg has cut it
+            progress = {"done": 0}
+            progress_lock = threading.Lock()
+            def chunk_done(_):
+                # The total is the number of chunks cut so far; it grows until the download ends
+                with progress_lock:
+                    progress["done"] += 1
+                    print(f"ASR [Task ID: {task_id}]: Completed chunk {progress['done']}/{len(chunks)}", file=sys.stderr)
+            with ThreadPoolExecutor(max_workers=max(1, ASR_MAX_CONCURRENCY)) as pool:
+                futures = []
+                for chunk, chunk_dur in chunk_source(chunk_dir):
+                    with progress_lock:
+                        chunks.append((chunk, chunk_dur))
+                    save_chunk_layout(checkpoint_dir, chunks, None, streamed=True, complete=False)
+                    futures.append(pool.submit(transcribe_chunk, len(futures), chunk, chunk_dur))
+                    print(f"ASR [Task ID: {task_id}]: Streamed chunk #{len(futures)} ({chunk_dur:.1f}s) queued", file=sys.stderr)
+                    futures[-1].add_done_callback(chunk_done)
+                stream_results = [fut.result() for fut in futures]
+            save_chunk_layout(checkpoint_dir, chunks, None, streamed=True)
+            if len(stream_results) == 1: single = stream_results[0]
+        elif len(chunks) == 1:
             # Direct call with task ID
-            ok, res = _call_qwen_audio(compressed_path, task_id)
+            single = transcribe_chunk(0, *chunks[0])
+        
+        duration = sum(d for _, d in chunks)
+        
+        # 2. Transcribe
+        if single is not None:
+            ok, res, _, resumed = single
             if not ok: return False, res
+            resumed_chunks = int(resumed)
             
-            # Clean (Basic Regex)
-            res = clean_asr_hallucinations(res)
-            
+            # Already cleaned by _call_qwen_audio's StreamAssembler
             final_text = res
             
             # Generate subtitles
-            all_sentences = estimate_subtitles_helper(res, duration)
+            all_sentences = chunk_subtitles(res, duration, 0, plan)
             
         else:
             # Chunking
             print(f"Audio too long ({duration}s), splitting...", file=sys.stderr)
-            with tempfile.TemporaryDirectory() as chunk_dir:
-                # ffmpeg segment
-                # -f segment -segment_time 300 -c copy
-                # Note: '-c copy' can sometimes produce chunks with weird timestamps or incomplete headers if keyframes don't align.
-                # Re-encoding ensures valid standalone files.
-                seg_pattern = os.path.join(chunk_dir, "chunk_%03d.mp3")
-                cmd = ["ffmpeg", "-i", compressed_path, "-f", "segment", 
-                       "-segment_time", str(CHUNK_DURATION), "-ar", "16000", "-ac", "1", "-b:a", "64k", seg_pattern]
-                subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-                
-                chunks = sorted([os.path.join(chunk_dir, f) for f in os.listdir(chunk_dir) if f.endswith(".mp3")])
+            
+            if chunk_source is not None:
+                results = stream_results
+            else:
+                results = [None] * len(chunks)
+                with ThreadPoolExecutor(max_workers=max(1, ASR_MAX_CONCURRENCY)) as pool:
+                    futures = {pool.submit(transcribe_chunk, i, chunk, chunk_dur): i for i, (chunk, chunk_dur) in enumerate(chunks)}
+                    for done, fut in enumerate(as_completed(futures), 1):
+                        results[futures[fut]] = fut.result()
+                        print(f"ASR [Task ID: {task_id}]: Completed chunk {done}/{len(chunks)}", file=sys.stderr)
+            
+            # Reassemble in chunk order
+            current_offset_ms = 0
+            
+            for i, (ok, res, chunk_dur, resumed) in enumerate(results):
+                resumed_chunks += int(resumed)
+                if not ok: 
+                    print(f"Chunk {i} failed: {res}", file=sys.stderr)
+                    failed_chunks += 1
+                    final_text += f"\n[...片段 {i+1} 转写失败，内容缺失...]\n"
+                    # We must advance time even if failed to keep alignment
+                    current_offset_ms += int(chunk_dur * 1000)
+                    continue 
                 
-                current_offset_ms = 0
+                final_text += res + "\n"
                 
-                for i, chunk in enumerate(chunks):
-                    print(f"ASR [Task ID: {task_id}]: Processing chunk {i+1}/{len(chunks)}...", file=sys.stderr)
-                    
-                    # Get exact duration of chunk for better alignment
-                    chunk_dur = get_audio_duration(chunk)
-                    
-                    ok, res = _call_qwen_audio(chunk, task_id)
-                    if not ok: 
-                        print(f"Chunk {i} failed: {res}", file=sys.stderr)
-                        final_text += f"\n[...片段 {i+1} 转写失败，内容缺失...]\n"
-                        # We must advance time even if failed to keep alignment
-                        current_offset_ms += int(chunk_dur * 1000)
-                        continue 
-                    
-                    # Convert to string and clean up
-                    if isinstance(res, list): 
-                         res = " ".join([str(x) for x in res])
-                    elif not isinstance(res, str):
-                         res = str(res)
-                    
-                    # Post-processing to remove hallucinations (e.g. repeated "呃")
-                    res = clean_asr_hallucinations(res)
+                # Generate subtitles for this chunk at its offset
+                all_sentences.extend(chunk_subtitles(res, chunk_dur, current_offset_ms, plan))
                     
-                    final_text += res + "\n"
-                    
-                    # Generate subtitles for this chunk
-                    chunk_subs = estimate_subtitles_helper(res, chunk_dur)
-                    
-                    # Adjust offsets
-                    for sub in chunk_subs:
-                        sub['begin_time'] += current_offset_ms
-                        sub['end_time'] += current_offset_ms
-                        all_sentences.append(sub)
-                        
-                    current_offset_ms += int(chunk_dur * 1000)
-
+                current_offset_ms += int(chunk_dur * 1000)
         
-        return True, {"text": final_text, "sentences": all_sentences}
+        if resumed_chunks:
+            print(f"ASR [Task ID: {task_id}]: Resumed {resumed_chunks}/{len(chunks)} chunks from checkpoints", file=sys.stderr)
+        return True, {"text": final_text, "sentences": all_sentences, "failed_chunks": failed_chunks,
+                      "resumed_chunks": resumed_chunks, "duration": duration}
 
     except Exception as e:
         return False, str(e)
     finally:
-        if is_temp and os.path.exists(compressed_path):
-            os.remove(compressed_path)
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+
+def response_output_tokens(response):
+    """output_tokens from a DashScope response's usage, or None."""
+    usage = getattr(response, "usage", None)
+    if not usage: return None
+    try:
+        return usage.get("output_tokens") if isinstance(usage, dict) else getattr(usage, "output_tokens", None)
+    except Exception:
+        return None
 
 def _call_qwen_audio(audio_path, task_id):
     """Call Qwen Audio API with task ID"""
     # Try models in order
     last_error = ""
+    try:
+        health = get_model_health()
+        models = health.candidates(MODEL_ASR_LIST)
+    except Exception as e:
+        return False, f"ASR model selection failed: {e}"
     
-    for model_name in MODEL_ASR_LIST:
+    for model_name in models:
         try:
             print(f"ASR [Task ID: {task_id}]: Trying model: {model_name}", file=sys.stderr)
             messages = [
@@ -833,13 +2510,14 @@ def _call_qwen_audio(audio_path, task_id):
             
             # Qwen3-Omni-Flash requires streaming
             # and might require explicit result collection
+            get_rate_limiter().acquire(model_name)
+            assembler = StreamAssembler()
             response_iterator = MultiModalConversation.call(
                 model=model_name, 
                 messages=messages,
                 stream=True
             )
             
-            full_content = ""
             last_response = None
             
             print(f"ASR [Task ID: {task_id}]: DEBUG: Starting stream for {model_name}", file=sys.stderr)
@@ -865,32 +2543,35 @@ def _call_qwen_audio(audio_path, task_id):
                         # If list (multimodal output?), process it
                         if isinstance(part, list):
                             # Usually [{"text": "..."}]
-                            text_part = ""
                             for item in part:
                                 if isinstance(item, dict) and 'text' in item:
-                                    text_part += item['text']
+                                    assembler.feed(item['text']) # APPEND, don't overwrite
                                 elif isinstance(item, str):
-                                    text_part += item
-                            
-                            if text_part:
-                                full_content += text_part # APPEND, don't overwrite
+                                    assembler.feed(item)
                         
                         elif isinstance(part, str):
-                            if part: full_content += part # APPEND, don't overwrite
+                            assembler.feed(part) # APPEND, don't overwrite
                             
                 else:
                     print(f"Stream Error Chunk: {response}", file=sys.stderr)
                     # Don't raise immediately, try to continue? No, stream error is fatal usually.
                     raise Exception(f"Stream Error: {response.message}")
             
-            print(f"ASR [Task ID: {task_id}]: DEBUG: Stream finished. Content len: {len(full_content)}", file=sys.stderr)
+            # Cleaned incrementally while streaming; this is the only clean pass, callers use the text as-is
+            full_content = assembler.finish(response_output_tokens(last_response))
+            metrics = assembler.metrics()
+            print(f"ASR [Task ID: {task_id}]: DEBUG: Stream finished. Content len: {len(full_content)}, "
+                  f"TTFT: {metrics['ttft']}s, {metrics['tokens_per_s']} tokens/s", file=sys.stderr)
+            health.record_latency(model_name, **metrics)
             
-            if full_content:
+            if assembler.raw_text():
+                health.record_success(model_name)
                 return True, full_content
             elif last_response and last_response.status_code == HTTPStatus.OK:
                  # If full_content is empty but we had success, maybe it's in a different field?
                  # Just return empty string and let the outer loop handle "failed" if it's critical?
                  # But outer loop sees True and prints it.
+                 health.record_success(model_name)
                  return True, ""
             else:
                 response = last_response if last_response else response # Fallback
@@ -914,41 +2595,425 @@ def _call_qwen_audio(audio_path, task_id):
                 if "free tier" in err_msg or "quota" in err_msg or "payment" in err_msg or "arrearage" in err_msg or "does not support this input" in err_msg:
                     print(f"ASR Model {model_name} failed/unsupported ({response.code}), switching...", file=sys.stderr)
                     last_error = f"{model_name} error: {response.message}"
+                    health.record_failure(model_name, last_error, fatal=True)
                     continue # Try next model
                 else:
                     # Other error, might be persistent
                     print(f"ASR Model {model_name} failed: {response.message}", file=sys.stderr)
                     last_error = f"{model_name} error: {response.message}"
+                    health.record_failure(model_name, last_error)
                     continue
 
         except Exception as e:
             print(f"ASR Model {model_name} exception: {e}", file=sys.stderr)
+            if is_rate_limited(None, e):
+                # Throttling says nothing about the model's health
+                get_rate_limiter().penalize(model_name, 2)
+            else:
+                health.record_failure(model_name, e, fatal=is_model_unavailable(e))
             last_error = str(e)
             continue
             
     return False, f"All ASR models failed. Last error: {last_error}"
 
-# --- Backend: Alibaba NLP (LLM) ---
-def call_llm_analysis(text, api_key):
-    dashscope.api_key = api_key
-    prompt = f"""
-    Please analyze the following text and provide a JSON response with these fields:
-    1. "keywords": list of top 5 keywords (strings).
-    2. "summary": a concise summary (string).
-    3. "topics": list of objects, each with:
-       - "title" (string): topic description.
-       - "start_snippet" (string): the exact first 15-20 characters of this section in the text.
-       - "end_snippet" (string): the exact last 10 characters of this section.
+# --- Helper: ASR Jobs ---
+ASR_TASK_ID_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+def asr_task_id(value=None):
+    """Client-supplied task ID if it is a valid UUID, otherwise a fresh one."""
+    value = str(value or "").strip().lower()
+    return value if ASR_TASK_ID_RE.match(value) else str(uuid.uuid4())
+
+def asr_job_dir(task_id):
+    return os.path.join(get_output_dir(), "asr_jobs", task_id)
+
+def write_json_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def load_asr_job(task_id):
+    """job.json of an ASR task, or None."""
+    if not ASR_TASK_ID_RE.match(str(task_id)): return None
+    try:
+        with open(os.path.join(asr_job_dir(task_id), "job.json"), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+_asr_job_lock = threading.Lock()
+
+def save_asr_job(task_id, **fields):
+    """Merge fields into the task's job.json (the request thread and its background analysis both write it)."""
+    with _asr_job_lock:
+        job = load_asr_job(task_id) or {"task_id": task_id, "created_at": time.time()}
+        job.update(fields, updated_at=time.time())
+        os.makedirs(asr_job_dir(task_id), exist_ok=True)
+        try:
+            write_json_atomic(os.path.join(asr_job_dir(task_id), "job.json"), job)
+        except OSError as e:
+            print(f"Failed to write ASR job {task_id}: {e}", file=sys.stderr)
+        return job
+
+def asr_checkpoint_dir(task_id, fingerprint):
+    """Chunk checkpoints of a task, separated by the audio they were transcribed from."""
+    return os.path.join(asr_job_dir(task_id), f"chunks-{fingerprint}")
+
+def load_chunk_checkpoint(checkpoint_dir, index, total, duration):
+    """Raw transcript of an already finished chunk, or None if missing or from a different chunk plan."""
+    if not checkpoint_dir: return None
+    try:
+        with open(os.path.join(checkpoint_dir, f"chunk_{index:04d}.json"), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get("total") != total or abs(data.get("duration", -1) - duration) > 0.05: return None
+    return data.get("text")
+
+def save_chunk_checkpoint(checkpoint_dir, index, total, duration, text):
+    if not checkpoint_dir: return
+    try:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        write_json_atomic(os.path.join(checkpoint_dir, f"chunk_{index:04d}.json"),
+                          {"index": index, "total": total, "duration": duration, "text": text})
+    except OSError as e:
+        print(f"Failed to write ASR checkpoint {index}: {e}", file=sys.stderr)
+
+def remove_asr_job_source(job):
+    """Delete the job's ASR source unless it is the file served to the browser."""
+    source = job.get("source")
+    if source and source != job.get("saved_path") and os.path.exists(source):
+        try: os.remove(source)
+        except OSError: pass
+
+def finish_asr_job(task_id, response):
+    """Store the final response; the source audio is only dropped once every chunk succeeded."""
+    complete = not response.get("failed_chunks")
+    job = save_asr_job(task_id, status="done" if complete else "partial", result=response)
+    if complete: remove_asr_job_source(job)
+
+def cleanup_stale_outputs():
+    """
+    Remove ASR jobs (and their leftover source audio) and partial downloads not
+    touched for ASR_JOB_TTL_HOURS, and TTS segment directories older than
+    TTS_PARTS_TTL_HOURS.
+    """
+    jobs_root = os.path.join(get_output_dir(), "asr_jobs")
+    cutoff = time.time() - ASR_JOB_TTL_HOURS * 3600
+    try: names = os.listdir(jobs_root)
+    except OSError: names = []
+    for name in names:
+        job_dir = os.path.join(jobs_root, name)
+        try:
+            if os.path.getmtime(job_dir) >= cutoff: continue
+        except OSError:
+            continue
+        job = load_asr_job(name)
+        if job: remove_asr_job_source(job)
+        shutil.rmtree(job_dir, ignore_errors=True)
+    # Interrupted ranged downloads (download_ranged) are kept as long as jobs, for resuming
+    out_dir = get_output_dir()
+    downloads_root = partial_downloads_dir(out_dir)
+    try: names = os.listdir(downloads_root)
+    except OSError: names = []
+    for name in names:
+        path = os.path.join(downloads_root, name)
+        try:
+            if os.path.getmtime(path) < cutoff: os.remove(path)
+        except OSError:
+            continue
+    parts_root = os.path.join(out_dir, "tts_parts")
+    parts_cutoff = time.time() - TTS_PARTS_TTL_HOURS * 3600
+    try: names = os.listdir(parts_root)
+    except OSError: names = []
+    for name in names:
+        parts_dir = os.path.join(parts_root, name)
+        try:
+            if os.path.getmtime(parts_dir) >= parts_cutoff: continue
+        except OSError:
+            continue
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+# --- Helper: ASR Pipeline ---
+_asr_cache = None
+
+def get_asr_cache():
+    """Finished ASR results keyed by audio fingerprint under tts_output/asr_cache, or None if disabled."""
+    global _asr_cache
+    if _asr_cache is None and ASR_CACHE_MAX_MB > 0:
+        _asr_cache = DiskLRUCache(os.path.join(get_output_dir(), "asr_cache"), ASR_CACHE_MAX_MB * 1024 * 1024)
+    return _asr_cache
+
+def asr_result_to_payload(res):
+    """Extract transcript and subtitles (in seconds) from a run_ali_asr result."""
+    transcript = ""
+    subtitles = []
     
-    Text:
-    {text[:15000]} 
+    # Try to extract from result object or dict
+    if hasattr(res, 'sentences'):
+        sents = res.sentences
+    elif isinstance(res, dict) and 'sentences' in res:
+        sents = res['sentences']
+    else:
+        sents = []
+        
+    if hasattr(res, 'text'): transcript = res.text
+    elif isinstance(res, dict) and 'text' in res: transcript = res['text']
+    
+    # Cleanup is done per-chunk inside run_ali_asr
+    for s in sents:
+        text_s = s['text'] if isinstance(s, dict) else s.text
+        start = s['begin_time'] if isinstance(s, dict) else s.begin_time
+        end = s['end_time'] if isinstance(s, dict) else s.end_time
+        subtitles.append({
+            "text": text_s,
+            "start": start / 1000.0,
+            "end": end / 1000.0
+        })
+    return {"transcript": transcript, "subtitles": subtitles}
+
+def analysis_fields(ok_llm, llm_data):
+    """Response fields derived from call_llm_analysis."""
+    return {
+        "keywords": llm_data.get("keywords", []) if ok_llm else [],
+        "summary": llm_data.get("summary", "") if ok_llm else "",
+        "topics": llm_data.get("topics", []) if ok_llm else [],
+        "analysis": llm_data if ok_llm else None,
+        "analysis_status": "done" if ok_llm else "failed"
+    }
+
+# Analysis fields of a task whose LLM analysis is still running in the background
+PENDING_ANALYSIS = {"keywords": [], "summary": "", "topics": [], "analysis": None, "analysis_status": "pending"}
+
+_analysis_executor = None
+_analysis_executor_lock = threading.Lock()
+
+def get_analysis_executor():
+    global _analysis_executor
+    with _analysis_executor_lock:
+        if _analysis_executor is None:
+            _analysis_executor = ThreadPoolExecutor(max_workers=max(1, ASR_ANALYSIS_WORKERS))
+        return _analysis_executor
+
+def run_background_analysis(task_id, payload, key, fingerprint=None):
+    """Analyze payload's transcript, store the fields in the task's job.json and cache the complete payload."""
+    try:
+        fields = analysis_fields(*call_llm_analysis(payload["transcript"], key))
+    except Exception as e:
+        print(f"ASR [Task ID: {task_id}]: Background analysis failed: {e}", file=sys.stderr)
+        fields = analysis_fields(False, None)
+    save_asr_job(task_id, analysis_status=fields["analysis_status"], analysis_fields=fields)
+    print(f"ASR [Task ID: {task_id}]: Background analysis {fields['analysis_status']}", file=sys.stderr)
+    cache = get_asr_cache()
+    if cache and fingerprint and fields["analysis"] is not None:
+        cache.put(fingerprint, {"payload": dict(payload, **fields)})
+
+def transcribe_and_analyze(asr_source, key, task_id, background_analysis=False, fingerprint=None, asr_result=None):
+    """
+    run_ali_asr + call_llm_analysis behind the fingerprint-keyed result cache.
+    Chunks are checkpointed under the task's job directory, so calling this
+    again with the same task_id and audio only transcribes missing chunks.
+    With background_analysis the transcript is returned as soon as ASR is done
+    and the LLM analysis continues on a worker thread (analysis_status
+    "pending"; see /api/asr/<task_id>/analysis). A known fingerprint (from the
+    URL cache) skips decoding asr_source to compute it. asr_result is a
+    run_ali_asr result obtained while asr_source was still downloading; it is
+    analyzed and cached without transcribing again.
+    Returns (success, payload or error message); payload holds transcript,
+    subtitles, keywords, summary, topics, analysis, analysis_status,
+    failed/resumed chunk counts and whether it was cached.
+    """
+    def analyze(payload, cacheable, cached_transcript=False):
+        """Add the analysis fields to payload (or schedule them) and cache the result."""
+        if background_analysis:
+            if cache and cacheable and not cached_transcript:
+                # Cache the transcript now; the background job adds the analysis once it succeeds
+                cache.put(fingerprint, {"payload": dict(payload, **analysis_fields(False, None))})
+            save_asr_job(task_id, analysis_status="pending")
+            get_analysis_executor().submit(run_background_analysis, task_id, dict(payload), key,
+                                           fingerprint if cacheable else None)
+            payload.update(PENDING_ANALYSIS)
+            return
+        # Use LLM for analysis as requested (qwen3-max)
+        payload.update(analysis_fields(*call_llm_analysis(payload["transcript"], key)))
+        save_asr_job(task_id, analysis_status=payload["analysis_status"], analysis_fields=None)
+        if cache and cacheable and (payload["analysis"] is not None or not cached_transcript):
+            cache.put(fingerprint, {"payload": payload})
+    
+    cache = get_asr_cache()
+    fingerprint = fingerprint or audio_fingerprint(asr_source)
+    if cache and fingerprint and asr_result is None:
+        entry = cache.get(fingerprint)
+        if entry:
+            print(f"ASR [Task ID: {task_id}]: Result cache hit ({fingerprint[:20]})", file=sys.stderr)
+            payload = entry["payload"]
+            if payload.get("analysis") is None:
+                # Transcript was cached but the analysis failed last time
+                analyze(payload, True, cached_transcript=True)
+            return True, dict(payload, cached=True, failed_chunks=0, resumed_chunks=0)
+    
+    res = asr_result
+    if res is None:
+        checkpoint_dir = asr_checkpoint_dir(task_id, fingerprint) if fingerprint else None
+        ok, res = run_ali_asr(asr_source, key, task_id, checkpoint_dir=checkpoint_dir)
+        if not ok: return False, res
+    payload = asr_result_to_payload(res)
+    
+    # Analyze; transcripts with failed-chunk placeholders are not worth caching
+    analyze(payload, bool(fingerprint) and not res.get("failed_chunks"))
+    
+    return True, dict(payload, cached=False, failed_chunks=res.get("failed_chunks", 0),
+                      resumed_chunks=res.get("resumed_chunks", 0))
+
+def stream_checkpoint_name(url):
+    """
+    Checkpoint directory name (see asr_checkpoint_dir) of a streamed
+    transcription. It is keyed by the URL, so a reused task_id never restores
+    chunks cut from a different download.
+    """
+    return "stream-" + hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+
+def finished_download(path):
+    """A DownloadTail and download future for a file already on disk, to replay its streamed chunking."""
+    tail = DownloadTail()
+    tail.update(path, os.path.getsize(path))
+    tail.finish()
+    download = Future()
+    download.set_result({"ok": True, "path": path})
+    return tail, download
+
+def transcribe_download_stream(tail, download, api_key, task_id, checkpoint_name):
+    """
+    run_ali_asr over a download in progress (segment_stream_for_asr), so the
+    first chunks are transcribed while the rest of the media is still being
+    downloaded; download is the future of the fetch_url_media call feeding
+    tail. Chunks are checkpointed under checkpoint_name; the fixed-length
+    segments of the same bytes are identical, so a resumed task replaying
+    the download only transcribes the chunks that are missing.
+    Returns the run_ali_asr result, or None if nothing was streamed (URL
+    cache hit, download error) or ffmpeg could not decode all of the
+    download from a pipe; the caller then transcribes the finished file.
+    """
+    if not tail.wait_started(): return None
+    ok, res = run_ali_asr(None, api_key, task_id, checkpoint_dir=asr_checkpoint_dir(task_id, checkpoint_name),
+                          chunk_source=lambda chunk_dir: segment_stream_for_asr(tail, chunk_dir))
+    if not ok:
+        print(f"ASR [Task ID: {task_id}]: Streaming transcription failed ({res}), waiting for the full download", file=sys.stderr)
+        return None
+    fetched = download.result()
+    if not fetched["ok"]: return None
+    # An MP4 with its index at the end decodes from a pipe without error but loses its samples.
+    # The full decode is the one the fingerprint needs next, so it is memoized, not extra work
+    try: total = scan_audio(fetched["path"])["duration"]
+    except Exception: total = get_audio_duration(fetched["path"])
+    if total and res["duration"] < total - max(2.0, total * 0.02):
+        print(f"ASR [Task ID: {task_id}]: Streaming only decoded {res['duration']:.1f}s of {total:.1f}s, "
+              "transcribing the full download", file=sys.stderr)
+        return None
+    return res
+
+def asr_job_result(job):
+    """Stored response of a finished task, with the background analysis merged in once available."""
+    result = dict(job.get("result") or {})
+    if result and job.get("analysis_fields"):
+        result.update(job["analysis_fields"])
+    return result
+
+def asr_chunk_events(task_id, sent):
+    """SSE chunk events for checkpoints of task_id not yet in sent (a set of (dir, index) that is updated)."""
+    job_dir = asr_job_dir(task_id)
+    try:
+        dirs = [os.path.join(job_dir, n) for n in os.listdir(job_dir) if n.startswith("chunks-")]
+    except OSError:
+        return []
+    layouts = [(os.path.getmtime(d), d) for d in dirs if os.path.exists(os.path.join(d, "layout.json"))]
+    if not layouts: return []
+    checkpoint_dir = max(layouts)[1]
+    layout = load_chunk_layout(checkpoint_dir)
+    if not layout: return []
+    
+    durations = layout["durations"]
+    plan = layout.get("plan")
+    # Chunks of a download in progress: the total is unknown until the last one is cut
+    total = len(durations) if layout.get("complete", True) else None
+    events = []
+    offset_ms = 0
+    for i, chunk_dur in enumerate(durations):
+        chunk_offset_ms = offset_ms
+        offset_ms += int(chunk_dur * 1000)
+        if (checkpoint_dir, i) in sent: continue
+        text = load_chunk_checkpoint(checkpoint_dir, i, None if layout.get("streamed") else len(durations), chunk_dur)
+        if text is None: continue
+        sent.add((checkpoint_dir, i))
+        subs = chunk_subtitles(text, chunk_dur, chunk_offset_ms, plan)
+        events.append(sse_event("chunk", {
+            "index": i,
+            "total": total,
+            "text": text,
+            "subtitles": [{"text": sub["text"], "start": sub["begin_time"] / 1000.0, "end": sub["end_time"] / 1000.0} for sub in subs]
+        }))
+    return events
+
+def stream_asr_job(task_id):
+    """
+    Follow an ASR task through its job file and chunk checkpoints, so the
+    stream can be served by any worker while another one runs the job.
+    Yields SSE events:
+      chunk    - {index, total, text, subtitles} as each chunk finishes (completion order)
+      done     - the final /api/asr response, including the LLM analysis
+      analysis - {keywords, summary, topics, analysis, analysis_status}, only for
+                 analysis=background tasks whose analysis was still pending at done
+      error    - {error}
     """
+    started = last_write = time.time()
+    sent = set()
+    done_sent = False
+    while True:
+        now = time.time()
+        job = load_asr_job(task_id)
+        if job is None:
+            # The stream may be opened before the upload request has created the job
+            if now - started > ASR_STREAM_JOB_WAIT:
+                yield sse_event("error", {"error": "task_not_found"})
+                return
+        elif job.get("status") == "uploading":
+            pass # created from the query string before the body was read; wait up to ASR_STREAM_MAX_DURATION
+        else:
+            for event in asr_chunk_events(task_id, sent):
+                last_write = now
+                yield event
+            if job.get("status") in ("done", "partial") and job.get("result"):
+                result = asr_job_result(job)
+                if not done_sent:
+                    done_sent = True
+                    last_write = now
+                    yield sse_event("done", result)
+                    if result.get("analysis_status") != "pending": return
+                elif result.get("analysis_status") != "pending":
+                    yield sse_event("analysis", {k: result.get(k) for k in PENDING_ANALYSIS})
+                    return
+            if job.get("status") == "failed":
+                yield sse_event("error", {"error": job.get("error") or "asr_failed"})
+                return
+        if now - started > ASR_STREAM_MAX_DURATION:
+            yield sse_event("error", {"error": "stream_timeout"})
+            return
+        if now - last_write > 15:
+            # Comment line keeps proxies from closing an idle stream
+            last_write = now
+            yield ": keepalive\n\n"
+        time.sleep(ASR_STREAM_POLL_INTERVAL)
+
+# --- Backend: Alibaba NLP (LLM) ---
+def _call_llm_json(prompt):
+    """One MODEL_LLM call whose reply is parsed as JSON. Returns (success, data or error message)."""
     try:
-        resp = dashscope.Generation.call(
+        resp = call_dashscope(MODEL_LLM, lambda: dashscope.Generation.call(
             model=MODEL_LLM,
             messages=[{'role': 'user', 'content': prompt}],
             result_format='message'
-        )
+        ))
         
         if resp.status_code == HTTPStatus.OK:
             content = resp.output.choices[0].message.content
@@ -964,6 +3029,116 @@ def call_llm_analysis(text, api_key):
     except Exception as e:
         return False, str(e)
 
+def _analyze_text_once(text):
+    prompt = f"""
+    Please analyze the following text and provide a JSON response with these fields:
+    1. "keywords": list of top 5 keywords (strings).
+    2. "summary": a concise summary (string).
+    3. "topics": list of objects, each with:
+       - "title" (string): topic description.
+       - "start_snippet" (string): the exact first 15-20 characters of this section in the text.
+       - "end_snippet" (string): the exact last 10 characters of this section.
+    
+    Text:
+    {text[:LLM_ANALYSIS_CHUNK_CHARS]} 
+    """
+    return _call_llm_json(prompt)
+
+def merge_chunk_analyses(parts):
+    """Local reduce of per-chunk analyses: most frequent keywords, joined summaries, topics in text order."""
+    counts = {}
+    for part in parts:
+        for kw in part.get("keywords") or []:
+            kw = str(kw).strip()
+            if kw: counts[kw] = counts.get(kw, 0) + 1
+    # Stable sort keeps first appearance order among equally frequent keywords
+    keywords = sorted(counts, key=lambda k: -counts[k])[:5]
+    summary = "\n".join(str(p.get("summary") or "").strip() for p in parts if p.get("summary"))
+    topics = [t for p in parts for t in (p.get("topics") or []) if isinstance(t, dict)]
+    return {"keywords": keywords, "summary": summary, "topics": topics}
+
+def _reduce_chunk_analyses(parts):
+    """
+    Merge per-chunk analyses with one more LLM call. Merged topics refer to
+    ranges of the chunk topics, so their snippets stay exact quotes of the
+    transcript. Falls back to merge_chunk_analyses if the call fails.
+    """
+    local = merge_chunk_analyses(parts)
+    chunk_topics = local["topics"]
+    digest = {
+        "parts": [{"part": i + 1, "summary": p.get("summary", ""), "keywords": p.get("keywords", [])}
+                  for i, p in enumerate(parts)],
+        "topics": [{"id": i, "title": t.get("title", "")} for i, t in enumerate(chunk_topics)]
+    }
+    prompt = f"""
+    The following JSON holds analyses of consecutive parts of one long transcript, and the
+    numbered topics found in those parts (in text order).
+    Combine them into a JSON response for the whole transcript with these fields:
+    1. "keywords": list of top 5 keywords (strings).
+    2. "summary": a concise summary of the whole transcript (string).
+    3. "topics": list of objects in text order, each merging a run of consecutive topics:
+       - "title" (string): topic description.
+       - "from" (integer): id of the first topic in the run.
+       - "to" (integer): id of the last topic in the run.
+    
+    Data:
+    {json.dumps(digest, ensure_ascii=False)}
+    """
+    ok, data = _call_llm_json(prompt)
+    if not ok or not isinstance(data, dict):
+        print(f"LLM analysis reduce failed, merging locally: {data}", file=sys.stderr)
+        return local
+    
+    topics = []
+    last_to = -1
+    for t in data.get("topics") or []:
+        try:
+            start, end = int(t["from"]), int(t["to"])
+        except (KeyError, TypeError, ValueError):
+            topics = None
+            break
+        if not (last_to < start <= end < len(chunk_topics)):
+            topics = None
+            break
+        topics.append({
+            "title": t.get("title") or chunk_topics[start].get("title", ""),
+            "start_snippet": chunk_topics[start].get("start_snippet", ""),
+            "end_snippet": chunk_topics[end].get("end_snippet", "")
+        })
+        last_to = end
+    return {
+        "keywords": data.get("keywords") or local["keywords"],
+        "summary": data.get("summary") or local["summary"],
+        "topics": topics if topics else chunk_topics
+    }
+
+def call_llm_analysis(text, api_key):
+    """
+    Keywords, summary and topics of text. Texts longer than
+    LLM_ANALYSIS_CHUNK_CHARS are split on sentence boundaries, the parts are
+    analyzed concurrently and their results merged in a final reduce call,
+    so long transcripts are covered completely with the same output schema.
+    """
+    dashscope.api_key = api_key
+    text = str(text or "")
+    if len(text) <= LLM_ANALYSIS_CHUNK_CHARS:
+        return _analyze_text_once(text)
+    
+    chunks = split_text_for_say(text, LLM_ANALYSIS_CHUNK_CHARS)
+    print(f"LLM analysis: {len(text)} chars in {len(chunks)} parts", file=sys.stderr)
+    with ThreadPoolExecutor(max_workers=max(1, LLM_ANALYSIS_CONCURRENCY)) as pool:
+        results = list(pool.map(_analyze_text_once, chunks))
+    
+    parts = [data for ok, data in results if ok and isinstance(data, dict)]
+    if not parts:
+        errors = [data for ok, data in results if not ok]
+        return False, errors[0] if errors else "Invalid JSON from LLM"
+    if len(parts) < len(chunks):
+        print(f"LLM analysis: {len(chunks) - len(parts)}/{len(chunks)} parts failed", file=sys.stderr)
+    if len(parts) == 1:
+        return True, parts[0]
+    return True, _reduce_chunk_analyses(parts)
+
 def call_llm_fix_punctuation(text, api_key):
     dashscope.api_key = api_key
     prompt = f"""
@@ -980,11 +3155,11 @@ def call_llm_fix_punctuation(text, api_key):
     {text[:15000]} 
     """
     try:
-        resp = dashscope.Generation.call(
+        resp = call_dashscope(MODEL_LLM_FAST, lambda: dashscope.Generation.call(
             model=MODEL_LLM_FAST, # Now Qwen-Max
             messages=[{'role': 'user', 'content': prompt}],
             result_format='message'
-        )
+        ))
         if resp.status_code == HTTPStatus.OK:
             return True, resp.output.choices[0].message.content
         return False, resp.message
@@ -1090,11 +3265,11 @@ def call_llm_advice(text, api_key, custom_prompt=None):
     {text[:8000]}
     """
     try:
-        resp = dashscope.Generation.call(
+        resp = call_dashscope(MODEL_LLM, lambda: dashscope.Generation.call(
             model=MODEL_LLM, # qwen3-max-2025-09-23
             messages=[{'role': 'user', 'content': prompt}],
             result_format='message'
-        )
+        ))
         if resp.status_code == HTTPStatus.OK:
             content = resp.output.choices[0].message.content
             
@@ -1134,10 +3309,10 @@ def call_qwen_ocr(image_path, api_key):
     ]
     
     try:
-        resp = MultiModalConversation.call(
+        resp = call_dashscope(MODEL_OCR, lambda: MultiModalConversation.call(
             model=MODEL_OCR,
             messages=messages
-        )
+        ))
         
         if resp.status_code == HTTPStatus.OK:
             return True, resp.output.choices[0].message.content[0]['text']
@@ -1183,6 +3358,21 @@ def api_voices():
     backend = AlibabaTTSBackend()
     return jsonify({"ok": True, "voices": backend.get_voices()})
 
+@app.route('/api/tts/cache', methods=['GET'])
+def api_tts_cache_stats():
+    cache = get_tts_cache()
+    if not cache: return jsonify({"ok": True, "enabled": False})
+    return jsonify({"ok": True, "enabled": True, "cache": cache.stats()})
+
+@app.route('/api/model-health', methods=['GET'])
+def api_model_health():
+    """Circuit-breaker state of the ASR/TTS fallback models, shared by all workers."""
+    return jsonify({
+        "ok": True,
+        "fallback_lists": {"asr": MODEL_ASR_LIST, "tts": MODEL_TTS_LIST},
+        "models": get_model_health().snapshot()
+    })
+
 @app.route('/api/get-config', methods=['GET'])
 def api_get_config():
     # Return non-sensitive config, or mask key if needed
@@ -1214,6 +3404,23 @@ def api_tts():
         out_dir = get_output_dir()
         final_path = os.path.join(out_dir, filename)
         
+        try:
+            concurrency = int(data.get("concurrency") or TTS_MAX_CONCURRENCY)
+        except (TypeError, ValueError):
+            concurrency = TTS_MAX_CONCURRENCY
+        concurrency = max(1, min(concurrency, TTS_MAX_CONCURRENCY))
+        # Incremental mode: tts_id of an earlier segmented request to diff against
+        base_id = data.get("base_id")
+        cleanup_stale_outputs()
+        
+        # Progressive mode: SSE feed of per-segment audio, merged file at the end
+        if data.get("stream"):
+            return Response(
+                stream_with_context(stream_tts(backend, text, voice, filename, concurrency, base_id)),
+                mimetype="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+        
         # Check length
         if len(text) <= MAX_SAY_SEGMENT_LENGTH:
             ok, err, subs = backend.generate(text, voice, final_path)
@@ -1226,177 +3433,221 @@ def api_tts():
                 "download_filename": filename
             })
         else:
-            # Segment and merge
-            with tempfile.TemporaryDirectory() as temp_dir:
-                segments = split_text_for_say(text, MAX_SAY_SEGMENT_LENGTH)
-                seg_files = []
-                all_subs = []
-                current_offset = 0.0
-                
-                for i, seg in enumerate(segments):
-                    seg_path = os.path.join(temp_dir, f"seg_{i}.wav")
-                    ok, err, subs = backend.generate(seg, voice, seg_path)
-                    if not ok: return jsonify({"ok": False, "error": f"Segment {i} failed: {err}"}), 500
-                    
-                    # Adjust subs
-                    dur = get_audio_duration(seg_path)
-                    for s in subs:
-                        s['start'] += current_offset
-                        s['end'] += current_offset
-                    all_subs.extend(subs)
-                    current_offset += dur
-                    
-                    seg_files.append(seg_path)
-                    time.sleep(0.2) # Rate limit protection
-                
-                # Merge
-                list_path = os.path.join(temp_dir, "list.txt")
-                with open(list_path, "w") as f:
-                    for p in seg_files: f.write(f"file '{p}'\n")
-                
-                try:
-                    subprocess.run(
-                        ["ffmpeg", "-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy", final_path],
-                        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-                    )
-                except Exception as e:
-                    return jsonify({"ok": False, "error": f"Merge failed: {e}"}), 500
-                
-                return jsonify({
-                    "ok": True,
-                    "audio_url": f"/tts_output/{filename}",
-                    "subtitles": all_subs,
-                    "download_filename": filename
-                })
+            # Segment and merge. Segment WAVs are kept for incremental re-synthesis.
+            tts_id, parts_dir = tts_parts_dir(filename)
+            segments = split_text_for_say(text, MAX_SAY_SEGMENT_LENGTH)
+            reuse = plan_segment_reuse(base_id, segments, voice)
+            print(f"TTS: {len(segments)} segments, concurrency={concurrency}", file=sys.stderr)
+            
+            ok, err, results = synthesize_segments(backend, segments, voice, parts_dir, concurrency, reuse)
+            if not ok:
+                shutil.rmtree(parts_dir, ignore_errors=True)
+                return jsonify({"ok": False, "error": err}), 500
+            write_tts_manifest(parts_dir, voice, segments, results)
+            
+            seg_files = []
+            all_subs = []
+            current_offset = 0.0
+            
+            # Stitch back in order, offsets from each segment's real duration
+            for seg_path, subs in results:
+                dur = get_audio_duration(seg_path)
+                for s in subs:
+                    all_subs.append(dict(s, start=s['start'] + current_offset, end=s['end'] + current_offset))
+                current_offset += dur
+                seg_files.append(seg_path)
+            
+            # Merge
+            ok, err = merge_audio_files(seg_files, final_path)
+            if not ok:
+                shutil.rmtree(parts_dir, ignore_errors=True)
+                return jsonify({"ok": False, "error": err}), 500
+            
+            return jsonify({
+                "ok": True,
+                "audio_url": f"/tts_output/{filename}",
+                "subtitles": all_subs,
+                "download_filename": filename,
+                "tts_id": tts_id,
+                "reused_segments": len(reuse)
+            })
                 
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
+@app.route('/api/asr/cache', methods=['GET'])
+def api_asr_cache_stats():
+    cache = get_asr_cache()
+    url_cache = get_url_cache()
+    url_stats = url_cache.stats() if url_cache else None
+    if not cache: return jsonify({"ok": True, "enabled": False, "url_cache": url_stats})
+    return jsonify({"ok": True, "enabled": True, "cache": cache.stats(), "url_cache": url_stats})
+
+def wants_background_analysis(params):
+    """analysis=background: return the transcript first and fetch the analysis from /api/asr/<task_id>/analysis."""
+    return str(params.get("analysis") or "").lower() == "background"
+
 @app.route('/api/asr', methods=['POST'])
 def api_asr():
-    if 'file' not in request.files: return jsonify({"ok": False, "error": "missing_file"}), 400
+    # A task_id in the query string is read without consuming the body, so the job exists (status
+    # "uploading") while a long upload is still arriving and /api/asr/<task_id>/stream can wait for it
+    early_task_id = request.args.get("task_id")
+    if early_task_id and ASR_TASK_ID_RE.match(early_task_id.strip().lower()):
+        early_task_id = early_task_id.strip().lower()
+        save_asr_job(early_task_id, status="uploading")
+    else:
+        early_task_id = None
+    
+    if 'file' not in request.files:
+        if early_task_id: save_asr_job(early_task_id, status="failed", error="missing_file")
+        return jsonify({"ok": False, "error": "missing_file"}), 400
     file = request.files['file']
     
-    # Generate unique task ID for this ASR request
-    task_id = str(uuid.uuid4())
+    # Generate unique task ID for this ASR request (clients may pick it so they can resume after a timeout)
+    task_id = early_task_id or asr_task_id(request.form.get("task_id"))
     print(f"ASR Request [Task ID: {task_id}]: Starting new ASR task", file=sys.stderr)
     
     key = request.form.get("dashscopeKey") or os.environ.get("DASHSCOPE_API_KEY")
     # For ASR, we might need a key. If not provided in form (frontend update needed?), check ENV.
     # We will assume ENV is primary or frontend sends it.
     
-    if not key: return jsonify({"ok": False, "error": "missing_api_key"}), 401
+    if not key:
+        if early_task_id: save_asr_job(task_id, status="failed", error="missing_api_key")
+        return jsonify({"ok": False, "error": "missing_api_key"}), 401
     
     # Get file extension from original filename
     file_ext = os.path.splitext(file.filename)[1] if file.filename else '.mp3'
     
-    # Save uploaded file to persistent storage with browser-compatible format
+    # The upload is written to disk exactly once and ASR reads that file
     out_dir = get_output_dir()
+    cleanup_stale_outputs()
+    target_ext = browser_target_ext(file_ext)
+    if target_ext is None:
+        # Already browser-compatible: save straight to persistent storage
+        saved_filename = f"asr-{uuid.uuid4()}{file_ext}"
+        asr_source = os.path.join(out_dir, saved_filename)
+    else:
+        # Needs a transcode: keep the upload in the job directory, where it stays
+        # until ASR has finished every chunk, and transcode into tts_output meanwhile
+        saved_filename = f"asr-{uuid.uuid4()}{target_ext}"
+        os.makedirs(asr_job_dir(task_id), exist_ok=True)
+        asr_source = os.path.join(asr_job_dir(task_id), f"source{file_ext}")
+    file.save(asr_source)
     
-    # First, save to a temp location
-    with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as temp_file:
-        temp_path = temp_file.name
-        file.save(temp_path)
+    # Detect file type (video or audio); the transcode keeps the same kind
+    file_type = get_file_type(asr_source)
+    save_asr_job(task_id, status="running", source=asr_source, saved_path=os.path.join(out_dir, saved_filename),
+                 audio_url=f"/tts_output/{saved_filename}", file_type=file_type)
     
-    # Convert to browser-compatible format if needed
-    converted_success, converted_path, convert_error = convert_to_browser_compatible(temp_path, file_ext)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        # Browser-compatible transcode runs concurrently with ASR preprocessing
+        transcode = None
+        if target_ext is not None:
+            transcode = pool.submit(convert_to_browser_compatible, asr_source, file_ext, os.path.join(out_dir, saved_filename))
+        
+        # Process ASR with task ID
+        ok, payload = transcribe_and_analyze(asr_source, key, task_id, background_analysis=wants_background_analysis(request.form))
+        
+        saved_filename, saved_path = finish_browser_copy(asr_source, file_ext, out_dir, saved_filename, transcode)
+        if not os.path.exists(asr_source):
+            # Transcode failed and the upload itself is now the served file
+            asr_source = saved_path
+        save_asr_job(task_id, source=asr_source, saved_path=saved_path, audio_url=f"/tts_output/{saved_filename}")
     
-    if not converted_success:
-        # If conversion failed, try to use original file
-        print(f"Conversion failed: {convert_error}, using original file", file=sys.stderr)
-        converted_path = temp_path
-        # Keep original extension
-        saved_filename = f"asr-{uuid.uuid4()}{file_ext}"
-    else:
-        # Use converted file (extension will be .mp3 or .mp4)
-        converted_ext = os.path.splitext(converted_path)[1]
-        saved_filename = f"asr-{uuid.uuid4()}{converted_ext}"
+    if not ok:
+        save_asr_job(task_id, status="failed", error=payload)
+        return jsonify({"ok": False, "task_id": task_id, "error": payload}), 500
     
-    # Save to persistent storage
-    saved_path = os.path.join(out_dir, saved_filename)
-    shutil.move(converted_path, saved_path)
+    response = {
+        "ok": True,
+        "task_id": task_id,  # Return task ID to client
+        "audio_url": f"/tts_output/{saved_filename}",
+        "file_type": file_type,  # Added file_type field
+        **payload
+    }
+    # The upload is removed here once complete; otherwise it is kept for resume
+    finish_asr_job(task_id, response)
+    return jsonify(response)
+
+@app.route('/api/asr/<task_id>/stream', methods=['GET'])
+def api_asr_stream(task_id):
+    """Server-sent events with each chunk's text and subtitles as soon as it is transcribed."""
+    if not ASR_TASK_ID_RE.match(task_id): return jsonify({"ok": False, "error": "invalid_task_id"}), 400
+    return Response(
+        stream_with_context(stream_asr_job(task_id)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.route('/api/asr/<task_id>/resume', methods=['POST'])
+def api_asr_resume(task_id):
+    """
+    Resume an interrupted /api/asr or /api/asr-url task.
+    Only chunks without a checkpoint are transcribed; finished tasks return the stored result.
+    A task that was transcribed while downloading replays the same streamed
+    chunking over the downloaded file, so its stream checkpoints are reused;
+    if the download itself was interrupted, it is fetched again first.
+    """
+    job = load_asr_job(task_id)
+    if not job: return jsonify({"ok": False, "error": "task_not_found"}), 404
+    if job.get("status") == "done" and job.get("result"):
+        return jsonify(asr_job_result(job))
+    
+    data = request.get_json(silent=True) or request.form
+    key = data.get("dashscopeKey") or os.environ.get("DASHSCOPE_API_KEY")
+    if not key: return jsonify({"ok": False, "error": "missing_api_key"}), 401
     
-    # Clean up temp file if it's different from converted path
-    if temp_path != converted_path and os.path.exists(temp_path):
-        os.remove(temp_path)
+    stream_name = job.get("stream_checkpoints")
+    source = job.get("source")
+    if not source or not os.path.exists(source): source = job.get("saved_path")
+    if not source or not os.path.exists(source):
+        if not (stream_name and job.get("source_url")):
+            return jsonify({"ok": False, "error": "source_missing"}), 410
+        source = None
     
-    # Detect file type (video or audio) based on final saved file
-    file_type = get_file_type(saved_path)
+    print(f"ASR Resume [Task ID: {task_id}]: Resuming from {job.get('status')} state", file=sys.stderr)
+    save_asr_job(task_id, status="running")
+    if stream_name and not source:
+        fetched = fetch_url_media(job["source_url"], get_output_dir(), audio_only=True)
+        if not fetched["ok"]:
+            save_asr_job(task_id, status="failed", error=fetched["error"])
+            return jsonify({"ok": False, "task_id": task_id, "error": f"下载失败: {fetched['error']}"}), 400
+        source = fetched["path"]
+        # Served as downloaded; the browser-compatible copy is only made by /api/asr-url
+        job = save_asr_job(task_id, source=source, saved_path=source, audio_url=f"/tts_output/{os.path.basename(source)}",
+                           file_type=get_file_type(source), source_url=fetched["source_url"])
+    streamed = None
+    if stream_name:
+        tail, download = finished_download(source)
+        streamed = transcribe_download_stream(tail, download, key, task_id, stream_name)
+    ok, payload = transcribe_and_analyze(source, key, task_id, background_analysis=wants_background_analysis(data),
+                                         asr_result=streamed)
+    if not ok:
+        save_asr_job(task_id, status="failed", error=payload)
+        return jsonify({"ok": False, "task_id": task_id, "error": payload}), 500
     
-    # Process ASR with task ID
-    with tempfile.TemporaryDirectory() as temp_dir:
-        # Copy to temp directory for processing (to avoid modifying the original)
-        input_path = os.path.join(temp_dir, file.filename)
-        shutil.copy2(saved_path, input_path)
-        
-        ok, res = run_ali_asr(input_path, key, task_id)
-        if not ok: return jsonify({"ok": False, "error": res}), 500
-            
-        # Parse Result
-        # res structure from qwen3-asr-flash needs careful handling
-        # Assuming res is result object from SDK
-        
-        # We need to extract transcript, subtitles, etc.
-        # Since I cannot easily debug the exact response structure of qwen3-asr-flash without running it,
-        # I will assume standard SenseVoice/Paraformer style or generic JSON.
-        
-        # If result contains 'sentences', we use it.
-        transcript = ""
-        subtitles = []
-        
-        # Try to extract from result object or dict
-        if hasattr(res, 'sentences'):
-            sents = res.sentences
-        elif isinstance(res, dict) and 'sentences' in res:
-            sents = res['sentences']
-        else:
-            sents = []
-            # Maybe full text is in 'text' field?
-            # res might be whole 'output' object from wait()
-            pass
-            
-        if hasattr(res, 'text'): transcript = res.text
-        elif isinstance(res, dict) and 'text' in res: transcript = res['text']
-        
-        # --- REMOVED GLOBAL NLP CLEANUP ---
-        # It was causing text loss and timestamp misalignment.
-        # Now cleanup is done per-chunk inside run_ali_asr.
-        
-        # If run_ali_asr didn't provide sentences (e.g. error fallback or legacy path), try to use what we have
-        if not subtitles and sents:
-             for s in sents:
-                text_s = s['text'] if isinstance(s, dict) else s.text
-                start = s['begin_time'] if isinstance(s, dict) else s.begin_time
-                end = s['end_time'] if isinstance(s, dict) else s.end_time
-                subtitles.append({
-                    "text": text_s,
-                    "start": start / 1000.0,
-                    "end": end / 1000.0
-                })
-
-        # Analyze
-        # Use LLM for analysis as requested (qwen3-max)
-        ok_llm, llm_data = call_llm_analysis(transcript, key)
-        keywords = []
-        summary = ""
-        topics = []
-        if ok_llm:
-            keywords = llm_data.get("keywords", [])
-            summary = llm_data.get("summary", "")
-            topics = llm_data.get("topics", [])
-            
-        return jsonify({
-            "ok": True,
-            "task_id": task_id,  # Return task ID to client
-            "audio_url": f"/tts_output/{saved_filename}",
-            "file_type": file_type,  # Added file_type field
-            "transcript": transcript,
-            "subtitles": subtitles,
-            "keywords": keywords,
-            "summary": summary,
-            "topics": topics,
-            "analysis": llm_data if ok_llm else None
-        })
+    response = {
+        "ok": True,
+        "task_id": task_id,
+        "audio_url": job.get("audio_url"),
+        "file_type": job.get("file_type"),
+        **payload
+    }
+    if job.get("source_url"): response["source_url"] = job["source_url"]
+    finish_asr_job(task_id, response)
+    return jsonify(response)
+
+@app.route('/api/asr/<task_id>/analysis', methods=['GET'])
+def api_asr_analysis(task_id):
+    """Keywords, summary and topics of a task started with analysis=background."""
+    job = load_asr_job(task_id)
+    if not job: return jsonify({"ok": False, "error": "task_not_found"}), 404
+    fields = job.get("analysis_fields") or asr_job_result(job)
+    status = job.get("analysis_status") or fields.get("analysis_status") or "pending"
+    response = {"ok": True, "task_id": task_id, "status": status}
+    if status != "pending":
+        response.update({k: fields.get(k) for k in ("keywords", "summary", "topics", "analysis")})
+    return jsonify(response)
 
 @app.route('/api/asr-url', methods=['POST'])
 def api_asr_url():
@@ -1415,96 +3666,114 @@ def api_asr_url():
         key = data.get("dashscopeKey") or os.environ.get("DASHSCOPE_API_KEY")
         if not key: return jsonify({"ok": False, "error": "missing_api_key"}), 401
         
-        print(f"ASR-URL Request: URL={url}", file=sys.stderr)
+        task_id = asr_task_id(data.get("task_id"))
+        print(f"ASR-URL Request [Task ID: {task_id}]: URL={url}", file=sys.stderr)
+        cleanup_stale_outputs()
         
         # Step 1: Download audio/video from URL
         out_dir = get_output_dir()
-        success, downloaded_path, download_error, original_url = download_audio_video_from_url(url, out_dir)
+        # ASR only needs the audio track; full video is fetched with media=video or /api/asr/<task_id>/video
+        media = data.get("media") or "audio"
+        # An audio download is cut into ASR chunks and transcribed while it is still arriving
+        stream_name = stream_checkpoint_name(url) if media != "video" and ASR_URL_PIPELINE and shutil.which("ffmpeg") else None
+        save_asr_job(task_id, status="running", source_url=url, stream_checkpoints=stream_name)
+        tail = DownloadTail() if stream_name else None
+        with ThreadPoolExecutor(max_workers=1) as download_pool:
+            download = download_pool.submit(fetch_url_media, url, out_dir, audio_only=(media != "video"), tail=tail)
+            streamed = transcribe_download_stream(tail, download, key, task_id, stream_name) if tail else None
+            fetched = download.result()
+        downloaded_path, original_url = fetched["path"], fetched["source_url"]
         
-        if not success:
-            return jsonify({"ok": False, "error": f"下载失败: {download_error}"}), 400
+        if not fetched["ok"]:
+            save_asr_job(task_id, status="failed", error=fetched["error"])
+            return jsonify({"ok": False, "error": f"下载失败: {fetched['error']}"}), 400
         
-        # Step 2: Convert to browser-compatible format if needed
+        # A cached download of an already transcribed video reuses its fingerprint instead of decoding again
+        url_cache = get_url_cache() if fetched["media_key"] else None
+        asr_key = url_cache_key("asr", fetched["media_key"]) if url_cache else None
+        known = url_cache.get(asr_key) if url_cache and fetched["cached"] else None
+        fingerprint = known.get("fingerprint") if known else None
+        
+        # Step 2: Detect file type (video or audio)
+        # ASR decodes the original download rather than the browser-compatible transcode
         downloaded_ext = os.path.splitext(downloaded_path)[1]
-        converted_success, converted_path, convert_error = convert_to_browser_compatible(downloaded_path, downloaded_ext)
+        asr_source = downloaded_path
+        file_type = get_file_type(downloaded_path)
+        target_ext = browser_target_ext(downloaded_ext)
+        saved_filename = f"asr-{uuid.uuid4()}{target_ext}" if target_ext else os.path.basename(downloaded_path)
+        save_asr_job(task_id, status="running", source=asr_source, saved_path=os.path.join(out_dir, saved_filename),
+                     audio_url=f"/tts_output/{saved_filename}", file_type=file_type, source_url=original_url)
+        
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            # Step 3: Convert to browser-compatible format (if needed) while ASR runs
+            transcode = None
+            if target_ext is not None:
+                transcode = pool.submit(convert_to_browser_compatible, downloaded_path, downloaded_ext, os.path.join(out_dir, saved_filename))
+            
+            # Step 4: Process ASR (only analysis and caching are left if it was streamed)
+            ok, payload = transcribe_and_analyze(asr_source, key, task_id, background_analysis=wants_background_analysis(data),
+                                                 fingerprint=fingerprint, asr_result=streamed)
+            if ok and url_cache and not fingerprint and not payload.get("failed_chunks"):
+                fingerprint = audio_fingerprint(asr_source)
+                if fingerprint:
+                    url_cache.put(asr_key, {"media_key": fetched["media_key"], "fingerprint": fingerprint})
+            
+            saved_filename, saved_path = finish_browser_copy(downloaded_path, downloaded_ext, out_dir, saved_filename, transcode)
+            save_asr_job(task_id, saved_path=saved_path, audio_url=f"/tts_output/{saved_filename}")
         
+        if not ok:
+            save_asr_job(task_id, status="failed", error=payload)
+            return jsonify({"ok": False, "task_id": task_id, "error": payload}), 500
+        
+        response = {
+            "ok": True,
+            "task_id": task_id,
+            "audio_url": f"/tts_output/{saved_filename}",
+            "file_type": file_type,
+            **payload,
+            "source_url": original_url
+        }
+        # The original download is removed once complete (if it differs from the served file)
+        finish_asr_job(task_id, response)
+        return jsonify(response)
+                
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+@app.route('/api/asr/<task_id>/video', methods=['POST'])
+def api_asr_video(task_id):
+    """
+    Fetch the full video of an /api/asr-url task for playback, after it was
+    transcribed from the audio-only download.
+    """
+    job = load_asr_job(task_id)
+    if not job: return jsonify({"ok": False, "error": "task_not_found"}), 404
+    out_dir = get_output_dir()
+    if job.get("video_url") and os.path.exists(os.path.join(out_dir, os.path.basename(job["video_url"]))):
+        return jsonify({"ok": True, "task_id": task_id, "video_url": job["video_url"], "file_type": "video"})
+    if job.get("file_type") == "video":
+        # The transcribed file already is the video (direct link or media=video)
+        return jsonify({"ok": True, "task_id": task_id, "video_url": job.get("audio_url"), "file_type": "video"})
+    if not job.get("source_url"): return jsonify({"ok": False, "error": "no_source_url"}), 400
+    
+    try:
+        fetched = fetch_url_media(job["source_url"], out_dir)
+        if not fetched["ok"]:
+            return jsonify({"ok": False, "error": f"下载失败: {fetched['error']}"}), 400
+        downloaded_path = fetched["path"]
+        
+        downloaded_ext = os.path.splitext(downloaded_path)[1]
+        converted_success, converted_path, convert_error = convert_to_browser_compatible(
+            downloaded_path, downloaded_ext, os.path.join(out_dir, f"asr-{uuid.uuid4()}{browser_target_ext(downloaded_ext) or downloaded_ext}"))
         if not converted_success:
             print(f"Conversion failed: {convert_error}, using original file", file=sys.stderr)
             converted_path = downloaded_path
-            saved_filename = os.path.basename(downloaded_path)
-        else:
-            converted_ext = os.path.splitext(converted_path)[1]
-            saved_filename = f"asr-{uuid.uuid4()}{converted_ext}"
-            # Move converted file to persistent storage
-            saved_path = os.path.join(out_dir, saved_filename)
-            shutil.move(converted_path, saved_path)
-            converted_path = saved_path
-        
-        # Clean up original downloaded file if it's different
-        if downloaded_path != converted_path and os.path.exists(downloaded_path):
+        elif converted_path != downloaded_path and os.path.exists(downloaded_path):
             os.remove(downloaded_path)
         
-        # Step 3: Detect file type (video or audio)
-        file_type = get_file_type(converted_path)
-        
-        # Step 4: Process ASR
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Copy to temp directory for processing
-            input_path = os.path.join(temp_dir, saved_filename)
-            shutil.copy2(converted_path, input_path)
-            
-            ok, res = run_ali_asr(input_path, key)
-            if not ok: return jsonify({"ok": False, "error": res}), 500
-            
-            # Parse Result
-            transcript = ""
-            subtitles = []
-            
-            if hasattr(res, 'sentences'):
-                sents = res.sentences
-            elif isinstance(res, dict) and 'sentences' in res:
-                sents = res['sentences']
-            else:
-                sents = []
-                
-            if hasattr(res, 'text'): transcript = res.text
-            elif isinstance(res, dict) and 'text' in res: transcript = res['text']
-            
-            # Extract subtitles
-            if not subtitles and sents:
-                 for s in sents:
-                    text_s = s['text'] if isinstance(s, dict) else s.text
-                    start = s['begin_time'] if isinstance(s, dict) else s.begin_time
-                    end = s['end_time'] if isinstance(s, dict) else s.end_time
-                    subtitles.append({
-                        "text": text_s,
-                        "start": start / 1000.0,
-                        "end": end / 1000.0
-                    })
-            
-            # Analyze with LLM
-            ok_llm, llm_data = call_llm_analysis(transcript, key)
-            keywords = []
-            summary = ""
-            topics = []
-            if ok_llm:
-                keywords = llm_data.get("keywords", [])
-                summary = llm_data.get("summary", "")
-                topics = llm_data.get("topics", [])
-                
-            return jsonify({
-                "ok": True,
-                "audio_url": f"/tts_output/{saved_filename}",
-                "file_type": file_type,
-                "transcript": transcript,
-                "subtitles": subtitles,
-                "keywords": keywords,
-                "summary": summary,
-                "topics": topics,
-                "analysis": llm_data if ok_llm else None,
-                "source_url": original_url
-            })
-                
+        video_url = f"/tts_output/{os.path.basename(converted_path)}"
+        save_asr_job(task_id, video_url=video_url)
+        return jsonify({"ok": True, "task_id": task_id, "video_url": video_url, "file_type": get_file_type(converted_path)})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
@@ -1755,11 +4024,11 @@ def call_llm_format_essay(text, api_key):
     {safe_text}
     """
     try:
-        resp = dashscope.Generation.call(
+        resp = call_dashscope(MODEL_LLM_FAST, lambda: dashscope.Generation.call(
             model=MODEL_LLM_FAST, # Now Qwen-Max
             messages=[{'role': 'user', 'content': prompt}],
             result_format='message'
-        )
+        ))
         if resp.status_code == HTTPStatus.OK:
             return True, resp.output.choices[0].message.content
         return False, resp.message
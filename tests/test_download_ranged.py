@@ -0,0 +1,157 @@
+"""
+download_ranged 测试：本地 HTTP 服务器，覆盖并行分段下载、中断后续传、
+不支持 Range 的服务器以及 Range 探测失败。
+
+运行：python -m pytest tests/test_download_ranged.py
+"""
+import http.server
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server  # noqa: E402
+
+PART_SIZE = 64 * 1024
+BODY = os.urandom(PART_SIZE * 10 + 123)
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves BODY; the behaviour is controlled by the attributes of the server instance."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        srv = self.server
+        rng = self.headers.get("Range")
+        with srv.lock:
+            srv.requests.append(rng)
+            srv.in_flight += 1
+            srv.max_in_flight = max(srv.max_in_flight, srv.in_flight)
+        try:
+            self.respond(srv, rng)
+        finally:
+            with srv.lock:
+                srv.in_flight -= 1
+
+    def respond(self, srv, rng):
+        m = re.match(r"bytes=(\d+)-(\d+)$", rng or "")
+        if srv.probe_error and rng == "bytes=0-0":
+            self.send_error(500)
+            return
+        if not srv.ranges or not m:
+            self.send_body(200, BODY, {})
+            return
+        start, end = int(m.group(1)), int(m.group(2))
+        body = BODY[start:end + 1]
+        self.send_body(206, body, {"Content-Range": f"bytes {start}-{end}/{len(BODY)}", "ETag": '"v1"'},
+                       truncate=start in srv.fail_starts)
+
+    def send_body(self, status, body, headers, truncate=False):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Accept-Ranges", "bytes" if self.server.ranges else "none")
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        if truncate:
+            # Connection dropped halfway through the part, after the other parts in flight finished
+            time.sleep(0.3)
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        if len(body) > 1:
+            time.sleep(0.05)  # keep parts in flight long enough to overlap
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.bytes_served += len(body)
+
+
+@pytest.fixture
+def http_server():
+    srv = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    srv.daemon_threads = True
+    srv.lock = threading.Lock()
+    srv.requests, srv.in_flight, srv.max_in_flight, srv.bytes_served = [], 0, 0, 0
+    srv.ranges, srv.probe_error, srv.fail_starts = True, False, set()
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+@pytest.fixture(autouse=True)
+def small_parts(monkeypatch):
+    monkeypatch.setattr(server, "DOWNLOAD_RANGE_MIN_SIZE", PART_SIZE)
+    monkeypatch.setattr(server, "DOWNLOAD_RANGE_RETRIES", 1)
+
+
+def url_of(srv):
+    return f"http://127.0.0.1:{srv.server_address[1]}/media.mp3"
+
+
+def download(srv, tmp_path, progress=None):
+    out = tmp_path / "media.mp3"
+    server.download_ranged(url_of(srv), str(out), connections=4, part_size=PART_SIZE, progress=progress)
+    return out
+
+
+def test_parallel_ranges(http_server, tmp_path):
+    reported = []
+    out = download(http_server, tmp_path, progress=lambda path, n: reported.append(n))
+    assert out.read_bytes() == BODY
+    parts = [r for r in http_server.requests if r != "bytes=0-0"]
+    assert len(parts) == 11
+    assert all(r and r.startswith("bytes=") for r in parts)
+    assert http_server.max_in_flight > 1
+    assert reported[-1] == len(BODY)
+    # Partial file and its state are gone once the download is complete
+    assert os.listdir(server.partial_downloads_dir(str(tmp_path))) == []
+
+
+def test_resume_after_interruption(http_server, tmp_path):
+    http_server.fail_starts = {3 * PART_SIZE}
+    with pytest.raises(requests.exceptions.RequestException):
+        download(http_server, tmp_path)
+    partial_dir = server.partial_downloads_dir(str(tmp_path))
+    state_file = next(n for n in os.listdir(partial_dir) if n.endswith(".json"))
+    with open(os.path.join(partial_dir, state_file), encoding="utf-8") as f:
+        done = set(json.load(f)["done"])
+    assert 3 not in done and done
+    assert not (tmp_path / "media.mp3").exists()
+
+    http_server.fail_starts = set()
+    http_server.requests.clear()
+    http_server.bytes_served = 0
+    out = download(http_server, tmp_path)
+    assert out.read_bytes() == BODY
+    # Only the parts missing after the interruption were requested again
+    refetched = [r for r in http_server.requests if r != "bytes=0-0"]
+    missing = [i for i in range(11) if i not in done]
+    assert len(refetched) == len(missing)
+    assert http_server.bytes_served == 1 + sum(len(BODY[i * PART_SIZE:(i + 1) * PART_SIZE]) for i in missing)
+    assert os.listdir(partial_dir) == []
+
+
+def test_server_without_range_support(http_server, tmp_path):
+    http_server.ranges = False
+    out = download(http_server, tmp_path)
+    assert out.read_bytes() == BODY
+    # Probe plus one plain download
+    assert len(http_server.requests) == 2
+    assert not os.path.exists(server.partial_downloads_dir(str(tmp_path)))
+
+
+def test_probe_failure_falls_back(http_server, tmp_path):
+    http_server.probe_error = True
+    out = download(http_server, tmp_path)
+    assert out.read_bytes() == BODY
+    assert http_server.requests == ["bytes=0-0", None]
@@ -0,0 +1,86 @@
+"""
+ModelHealthTracker 测试：熔断、跳过、冷却后的单个试探、恢复，以及全部熔断时
+选择最早恢复的模型。
+
+运行：python -m pytest tests/test_model_health.py
+"""
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server  # noqa: E402
+
+
+@pytest.fixture
+def health(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "MODEL_BREAKER_THRESHOLD", 2)
+    monkeypatch.setattr(server, "MODEL_BREAKER_COOLDOWN", 60)
+    return server.ModelHealthTracker(str(tmp_path / "health.sqlite3"))
+
+
+def expire_cooldown(health, model):
+    health._connect().execute("UPDATE model_health SET open_until = ? WHERE model = ?", (time.time() - 1, model))
+
+
+def state_of(health, model):
+    return next(h for h in health.snapshot() if h["model"] == model)
+
+
+def test_opens_after_threshold_and_is_skipped(health):
+    health.record_failure("a", "boom")
+    assert list(health.candidates(["a", "b"])) == ["a", "b"]
+    health.record_failure("a", "boom")
+    assert state_of(health, "a")["state"] == "open"
+    assert list(health.candidates(["a", "b"])) == ["b"]
+
+
+def test_fatal_error_opens_immediately(health):
+    health.record_failure("a", "quota exceeded", fatal=True)
+    assert state_of(health, "a")["retry_in"] > 60
+
+
+def test_half_open_allows_a_single_probe(health):
+    health.record_failure("a", "boom", fatal=True)
+    expire_cooldown(health, "a")
+    assert state_of(health, "a")["state"] == "half_open"
+    assert health.try_acquire("a")
+    # The probe holds a lease, so other callers keep skipping the model
+    assert not health.try_acquire("a")
+
+
+def test_successful_probe_closes_the_circuit(health):
+    health.record_failure("a", "boom", fatal=True)
+    expire_cooldown(health, "a")
+    assert health.try_acquire("a")
+    health.record_success("a")
+    assert state_of(health, "a")["state"] == "closed"
+    assert list(health.candidates(["a", "b"])) == ["a", "b"]
+
+
+def test_failed_probe_reopens_with_longer_cooldown(health):
+    health.record_failure("a", "boom")
+    health.record_failure("a", "boom")
+    first = state_of(health, "a")["retry_in"]
+    expire_cooldown(health, "a")
+    assert health.try_acquire("a")
+    health.record_failure("a", "boom")
+    assert state_of(health, "a")["retry_in"] > first
+
+
+def test_all_open_falls_back_to_earliest_recovery(health, monkeypatch):
+    monkeypatch.setattr(server, "MODEL_BREAKER_MAX_COOLDOWN", 60)
+    health.record_failure("a", "boom", fatal=True)
+    monkeypatch.setattr(server, "MODEL_BREAKER_MAX_COOLDOWN", 5)
+    health.record_failure("b", "boom", fatal=True)
+    assert list(health.candidates(["a", "b"])) == ["b"]
+    assert list(health.candidates(["b", "a"])) == ["b"]
+
+
+def test_null_tracker_tries_every_model():
+    health = server.NullModelHealth()
+    health.record_failure("a", "boom", fatal=True)
+    assert list(health.candidates(["a", "b"])) == ["a", "b"]
+    assert health.snapshot() == []